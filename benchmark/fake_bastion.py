@@ -0,0 +1,105 @@
+"""
+Эмулятор jump host для бенчмарка: принимает ssh подключения с любым логином и паролем и пробрасывает каналы
+direct-tcpip до указанного адреса и порта (например, до fake_ssh.py).
+
+Запуск:
+    python benchmark/fake_bastion.py --port 2200
+"""
+import argparse
+import logging
+import select
+import socket
+import threading
+
+import paramiko
+
+
+class BastionServer(paramiko.ServerInterface):
+    """
+    Сервер ssh принимает любой логин и пароль и разрешает только каналы direct-tcpip.
+    """
+
+    def __init__(self):
+        self.destinations = {}
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        self.destinations[chanid] = destination
+        return paramiko.OPEN_SUCCEEDED
+
+
+def relay(channel, destination):
+    """
+    Пересылает данные между каналом и tcp подключением до destination, пока одна из сторон не закроется.
+    """
+    try:
+        sock = socket.create_connection(destination, timeout=10)
+    except OSError:
+        channel.close()
+        return
+    try:
+        while True:
+            readable, _, _ = select.select([channel, sock], [], [])
+            if channel in readable:
+                data = channel.recv(32768)
+                if not data:
+                    return
+                sock.sendall(data)
+            if sock in readable:
+                data = sock.recv(32768)
+                if not data:
+                    return
+                channel.sendall(data)
+    except (OSError, EOFError, paramiko.SSHException):
+        pass
+    finally:
+        sock.close()
+        channel.close()
+
+
+def handle_connection(sock, host_key):
+    """
+    Обрабатывает одно подключение к jump host: каждый открытый канал пробрасывается в отдельном потоке.
+    """
+    try:
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(host_key)
+        server = BastionServer()
+        transport.start_server(server=server)
+        while transport.is_active():
+            channel = transport.accept(1)
+            if channel is None:
+                continue
+            destination = server.destinations.pop(channel.get_id())
+            threading.Thread(target=relay, args=(channel, destination), daemon=True).start()
+    except (OSError, EOFError, paramiko.SSHException):
+        sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Эмулятор jump host с пробросом каналов direct-tcpip")
+    parser.add_argument("--port", type=int, default=2200)
+    args = parser.parse_args()
+
+    logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+    host_key = paramiko.RSAKey.generate(2048)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", args.port))
+    listener.listen(128)
+    print(f"Fake bastion on port {args.port}", flush=True)
+    while True:
+        sock, _ = listener.accept()
+        threading.Thread(target=handle_connection, args=(sock, host_key), daemon=True).start()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""
+Эмулятор API NetBox для бенчмарка: отдает синтетический инвентарь устройств, площадок, платформ и ролей
+через /api/dcim/devices/, /api/dcim/sites/, /api/dcim/platforms/ и /api/dcim/device-roles/ с пагинацией
+и фильтрами, которые использует main.py, и принимает bulk PATCH custom fields устройств.
+
+Запуск:
+    python benchmark/fake_netbox.py --port 8080 --devices 10000
+"""
+import argparse
+import json
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, urlencode
+
+from inventory import synthetic_device, last_updated
+
+# Параметры запроса, которые не являются фильтрами
+not_filters = {"limit", "offset", "fields", "brief", "ordering"}
+
+
+def netbox_device(device):
+    """
+    Функция преобразует синтетическое устройство в объект, как его отдает API NetBox.
+    """
+    return {
+        "id": device["id"],
+        "url": f"/api/dcim/devices/{device['id']}/",
+        "display": device["name"],
+        "name": device["name"],
+        "status": {"value": "active", "label": "Active"},
+        "primary_ip": {"id": device["id"], "address": f"{device['ip']}/32"},
+        "platform": ({"id": 1, "slug": device["netbox_platform"], "name": device["netbox_platform"]}
+                     if device["netbox_platform"] else None),
+        "site": {"id": 1, "slug": device["site"], "name": device["site"]},
+        "role": {"id": 1, "slug": device["role"], "name": device["role"]},
+        "custom_fields": {},
+        "last_updated": last_updated,
+    }
+
+
+def netbox_site(site_id, slug, region):
+    """
+    Функция возвращает объект площадки с регионом, как его отдает API NetBox.
+    """
+    return {
+        "id": site_id,
+        "url": f"/api/dcim/sites/{site_id}/",
+        "display": slug,
+        "name": slug,
+        "slug": slug,
+        "status": {"value": "active", "label": "Active"},
+        "region": {"id": int(region[len("region"):]) + 1, "slug": region, "name": region},
+        "physical_address": f"{slug}, Street {site_id}",
+        "custom_fields": {},
+        "last_updated": last_updated,
+    }
+
+
+def netbox_object(object_id, endpoint, slug):
+    """
+    Функция возвращает объект справочника (платформа, роль устройства), как его отдает API NetBox.
+    """
+    return {
+        "id": object_id,
+        "url": f"/api/dcim/{endpoint}/{object_id}/",
+        "display": slug,
+        "name": slug,
+        "slug": slug,
+        "last_updated": last_updated,
+    }
+
+
+def matches_custom_field(device, key, values):
+    """
+    Функция проверяет фильтр по custom field: cf_<name>, cf_<name>__empty, cf_<name>__lt и cf_<name>__gte.
+    Даты в ISO формате сравниваются как строки.
+    """
+    name, _, lookup = key[len("cf_"):].partition("__")
+    value = device["custom_fields"].get(name)
+    if lookup == "empty":
+        return (value in (None, "")) == (values[0].lower() in ("true", "1"))
+    if value in (None, ""):
+        return False
+    if lookup == "lt":
+        return value < values[0]
+    if lookup == "gte":
+        return value >= values[0]
+    return value in values
+
+
+def matches(device, filters):
+    """
+    Функция проверяет устройство на соответствие фильтрам запроса.
+    Поддерживаются фильтры, которые использует main.py, неизвестные фильтры игнорируются.
+    """
+    for key, values in filters.items():
+        if key == "status" and "active" not in values:
+            return False
+        if key == "has_primary_ip" and values[0].lower() not in ("true", "1"):
+            return False
+        if key == "name__isw" and not any(device["name"].lower().startswith(v.lower()) for v in values):
+            return False
+        if key == "id" and str(device["id"]) not in values:
+            return False
+        if key == "last_updated__gte" and last_updated < values[0]:
+            return False
+        if key == "site" and device["site"]["slug"] not in values:
+            return False
+        if key.startswith("cf_") and not matches_custom_field(device, key, values):
+            return False
+    return True
+
+
+class NetBoxHandler(BaseHTTPRequestHandler):
+    devices = []
+    # Справочники по пути API: площадки, платформы и роли устройств
+    objects = {}
+    latency = 0.0
+    protocol_version = "HTTP/1.1"
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("API-Version", "4.0")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        time.sleep(self.latency)
+        if url.path.rstrip("/") in ("/api", "/api/status"):
+            self.send_json(200, {"netbox-version": "4.0.0"})
+            return
+        if url.path.rstrip("/") in self.objects:
+            since = query.get("last_updated__gte", [""])[0]
+            found = [obj for obj in self.objects[url.path.rstrip("/")] if obj["last_updated"] >= since]
+        elif url.path.rstrip("/") == "/api/dcim/devices":
+            filters = {key: values for key, values in query.items() if key not in not_filters}
+            found = [device for device in self.devices if matches(device, filters)]
+        else:
+            self.send_json(404, {"detail": "Not found."})
+            return
+        limit = int(query.get("limit", ["50"])[0]) or 1000
+        offset = int(query.get("offset", ["0"])[0])
+        page = found[offset:offset + limit]
+        if query.get("brief", ["false"])[0].lower() in ("true", "1"):
+            page = [{key: device[key] for key in ("id", "url", "display", "name")} for device in page]
+
+        next_url = None
+        if offset + limit < len(found):
+            next_query = dict(query, limit=[str(limit)], offset=[str(offset + limit)])
+            next_url = f"http://{self.headers['Host']}{url.path}?{urlencode(next_query, doseq=True)}"
+        self.send_json(200, {"count": len(found), "next": next_url, "previous": None, "results": page})
+
+    def do_PATCH(self):
+        url = urlsplit(self.path)
+        time.sleep(self.latency)
+        if url.path.rstrip("/") != "/api/dcim/devices":
+            self.send_json(404, {"detail": "Not found."})
+            return
+        updates = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        by_id = {device["id"]: device for device in self.devices}
+        if not isinstance(updates, list) or any(update.get("id") not in by_id for update in updates):
+            self.send_json(400, {"detail": "Bulk update expects a list of existing device ids."})
+            return
+        for update in updates:
+            device = by_id[update["id"]]
+            # Как в NetBox: переданные custom fields объединяются с уже заданными
+            device["custom_fields"].update(update.get("custom_fields", {}))
+        self.send_json(200, [by_id[update["id"]] for update in updates])
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Эмулятор API NetBox с синтетическим инвентарем")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--devices", type=int, default=1000, help="кол-во устройств в инвентаре")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--drift-rate", type=float, default=0.1,
+                        help="доля устройств, у которых hostname на железке отличается от NetBox")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа API, секунд")
+    parser.add_argument("--platform-error-rate", type=float, default=0.0,
+                        help="доля устройств, у которых платформа в NetBox не задана или неверна")
+    args = parser.parse_args()
+
+    devices = [synthetic_device(index, args.seed, args.drift_rate, args.platform_error_rate)
+               for index in range(args.devices)]
+    NetBoxHandler.devices = [netbox_device(device) for device in devices]
+    regions = {device["site"]: device["region"] for device in devices}
+    platforms = sorted({device["platform"] for device in devices})
+    roles = sorted({device["role"] for device in devices})
+    NetBoxHandler.objects = {
+        "/api/dcim/sites": [netbox_site(site_id, slug, regions[slug])
+                            for site_id, slug in enumerate(sorted(regions), start=1)],
+        "/api/dcim/platforms": [netbox_object(object_id, "platforms", slug)
+                                for object_id, slug in enumerate(platforms, start=1)],
+        "/api/dcim/device-roles": [netbox_object(object_id, "device-roles", slug)
+                                   for object_id, slug in enumerate(roles, start=1)],
+    }
+    NetBoxHandler.latency = args.latency
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), NetBoxHandler)
+    server.daemon_threads = True
+    print(f"Fake NetBox with {args.devices} devices on http://127.0.0.1:{args.port}", flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""
+Эмулятор ssh для бенчмарка: принимает подключения на любой адрес 127.0.0.0/8 и отвечает диалектом CLI
+платформы синтетического устройства с этим адресом (Cisco XE, Eltex MES 23/24, ESR с commit/confirm,
+QTech QSW 46/33 и QSR). Поддерживает задержку ответа, разброс задержки и долю отказов.
+
+Запуск:
+    python benchmark/fake_ssh.py --port 2222 --devices 10000 --latency 0.05 --jitter 0.02 --failure-rate 0.01
+"""
+import argparse
+import logging
+import random
+import re
+import socket
+import threading
+import time
+
+import paramiko
+
+from inventory import synthetic_device, ip_to_index
+
+# Отличия диалектов CLI: вывод hostname в конфигурации, команда входа в конфигурацию,
+# команда сохранения, запрос подтверждения сохранения и вывод show version
+dialects = {
+    "cisco": {"quoted": False, "configure": "configure terminal", "commit": False,
+              "save": "write memory", "confirm": None,
+              "version": "Cisco IOS XE Software, Version 17.03.04a"},
+    "eltex-mesos23": {"quoted": False, "configure": "configure terminal", "commit": False,
+                      "save": "write memory", "confirm": "Overwrite file [startup-config].... (Y/N)[N] ?",
+                      "version": "SW version 4.0.18.2, System type: MES2324"},
+    "eltex-mesos24": {"quoted": True, "configure": "configure terminal", "commit": False,
+                      "save": "write startup-config", "confirm": None,
+                      "version": "Eltex MES2448 Software, Version 10.3.2"},
+    "eltex-esros": {"quoted": False, "configure": "configure", "commit": True,
+                    "save": None, "confirm": None,
+                    "version": "Software version: 1.18.2 build 12 (ESR-20)"},
+    "qtech": {"quoted": False, "configure": "config terminal", "commit": False,
+              "save": "write running-config",
+              "confirm": "Confirm to overwrite current startup-config configuration [Y/N]:",
+              "version": "QTECH QSW-4610-28T-AC Device, Software Version 7.2.3"},
+    "qsw33": {"quoted": True, "configure": "configure terminal", "commit": False,
+              "save": "write memory", "confirm": "Are you sure you want to save? (y/n) ",
+              "version": "QTECH QSW-3310-28TX-AC, Version 1.0.1"},
+    "qsr": {"quoted": False, "configure": "configure terminal", "commit": False,
+            "save": "write", "confirm": "Are you sure to overwrite /flash/startup.cfg? [Y/N] ",
+            "version": "QTECH QSR-2920-28 Router, Version 1.2"},
+}
+# Команды атрибутов конфигурации (domain name, snmp location и contact): запоминаются как есть
+# и выводятся в show running-config
+attribute_command = re.compile(r"^(ip domain[ -]name|domain name|snmp-server location|snmp-server contact) ")
+
+
+class DeviceServer(paramiko.ServerInterface):
+    """
+    Сервер ssh принимает любой логин и любой пароль, кроме reject_password, и открывает одну интерактивную сессию.
+    """
+
+    def __init__(self, reject_password):
+        self.shell_requested = threading.Event()
+        self.reject_password = reject_password
+
+    def check_auth_password(self, username, password):
+        if password == self.reject_password:
+            return paramiko.AUTH_FAILED
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        self.shell_requested.set()
+        return True
+
+
+class CliSession:
+    """
+    Интерактивная сессия CLI одного устройства. Hostname и атрибуты хранятся в общих словарях hostnames
+    и attributes, поэтому изменения сохраняются между подключениями к тому же устройству.
+    """
+
+    def __init__(self, channel, device, hostnames, attributes, args):
+        self.channel = channel
+        self.ip = device["ip"]
+        self.dialect = dialects[device["platform"]]
+        self.hostnames = hostnames
+        self.hostnames.setdefault(self.ip, device["hostname"])
+        self.attributes = attributes.setdefault(self.ip, {})
+        self.args = args
+        self.config_mode = False
+        self.candidate_hostname = None
+        self.candidate_attributes = {}
+        self.awaiting_confirm = False
+
+    def prompt(self):
+        hostname = self.hostnames[self.ip]
+        return f"{hostname}(config)#" if self.config_mode else f"{hostname}#"
+
+    def delay(self, factor=1.0):
+        time.sleep(max(0.0, random.gauss(self.args.latency, self.args.jitter)) * factor)
+
+    def send(self, text):
+        self.channel.sendall(text.encode())
+
+    def run(self):
+        self.send(f"\r\n{self.prompt()}")
+        buffer = ""
+        last_char = ""
+        while True:
+            data = self.channel.recv(4096)
+            if not data:
+                return
+            for char in data.decode(errors="ignore"):
+                # \r\n считается одним переводом строки
+                if char == "\n" and last_char == "\r":
+                    last_char = char
+                    continue
+                last_char = char
+                if char in "\r\n":
+                    self.send(f"{buffer}\r\n")
+                    if not self.execute(buffer.strip()):
+                        return
+                    buffer = ""
+                else:
+                    buffer += char
+
+    def execute(self, command):
+        """
+        Выполняет одну команду и печатает вывод и приглашение. Возвращает False, если сессия закрыта.
+        """
+        if not command:
+            self.send(self.prompt())
+            return True
+        self.delay()
+        if self.awaiting_confirm:
+            self.awaiting_confirm = False
+            if command.lower().startswith("y"):
+                self.delay(self.args.save_factor)
+                self.send("Copy succeeded\r\n")
+            self.send(self.prompt())
+            return True
+
+        output = ""
+        if command in ("exit", "quit", "logout") and not self.config_mode:
+            self.channel.close()
+            return False
+        elif command in ("end", "exit") and self.config_mode:
+            self.config_mode = False
+        elif command.startswith(("terminal ", "set cli pagination", "more off")):
+            pass
+        elif command == self.dialect["configure"] and not self.config_mode:
+            self.config_mode = True
+            output = "Enter configuration commands, one per line.  End with CNTL/Z.\r\n"
+        elif command == "show version":
+            output = self.dialect["version"] + "\r\n"
+        elif command.startswith("show running-config"):
+            hostname = self.hostnames[self.ip]
+            output = f'hostname "{hostname}"\r\n' if self.dialect["quoted"] else f"hostname {hostname}\r\n"
+            if "hostname" not in command:
+                output += "".join(f"{line}\r\n" for line in self.attributes.values())
+        elif command.startswith("hostname ") and self.config_mode:
+            if self.dialect["commit"]:
+                self.candidate_hostname = command.split(maxsplit=1)[1]
+            else:
+                self.hostnames[self.ip] = command.split(maxsplit=1)[1]
+        elif attribute_command.match(command) and self.config_mode:
+            key = attribute_command.match(command).group(1)
+            if self.dialect["commit"]:
+                self.candidate_attributes[key] = command
+            else:
+                self.attributes[key] = command
+        elif command == "do commit" and self.config_mode and self.dialect["commit"]:
+            if self.candidate_hostname:
+                self.hostnames[self.ip] = self.candidate_hostname
+                self.candidate_hostname = None
+            self.attributes.update(self.candidate_attributes)
+            self.candidate_attributes = {}
+            output = "Configuration has been successfully applied and saved to flash. Commit timer started.\r\n"
+        elif command in ("do confirm", "do save") and self.config_mode and self.dialect["commit"]:
+            self.delay(self.args.save_factor)
+            output = "Configuration has been confirmed.\r\n"
+        elif command == self.dialect["save"] and not self.config_mode:
+            if self.dialect["confirm"]:
+                self.awaiting_confirm = True
+                self.send(self.dialect["confirm"])
+                return True
+            self.delay(self.args.save_factor)
+            output = "Copy succeeded\r\n"
+        else:
+            output = "% Unrecognized command\r\n"
+        self.send(output + self.prompt())
+        return True
+
+
+def handle_connection(sock, host_key, hostnames, attributes, args):
+    """
+    Обрабатывает одно tcp подключение: с вероятностью failure_rate сразу закрывает его,
+    иначе поднимает ssh и запускает сессию CLI устройства с адресом, на который пришло подключение.
+    """
+    try:
+        if random.random() < args.failure_rate:
+            sock.close()
+            return
+        device = synthetic_device(ip_to_index(sock.getsockname()[0]), args.seed, args.drift_rate)
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(host_key)
+        server = DeviceServer(args.reject_password)
+        transport.start_server(server=server)
+        channel = transport.accept(30)
+        if channel is None or not server.shell_requested.wait(30):
+            transport.close()
+            return
+        CliSession(channel, device, hostnames, attributes, args).run()
+        transport.close()
+    except (OSError, EOFError, paramiko.SSHException):
+        sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Эмулятор ssh CLI сетевых устройств")
+    parser.add_argument("--port", type=int, default=2222)
+    parser.add_argument("--devices", type=int, default=1000, help="кол-во устройств в инвентаре")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--drift-rate", type=float, default=0.1,
+                        help="доля устройств, у которых hostname на железке отличается от NetBox")
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка ответа на команду, секунд")
+    parser.add_argument("--jitter", type=float, default=0.02, help="разброс задержки ответа, секунд")
+    parser.add_argument("--save-factor", type=float, default=10.0,
+                        help="во сколько раз сохранение конфигурации дольше обычной команды")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="доля подключений, которые сразу рвутся")
+    parser.add_argument("--reject-password", default="invalid", help="пароль, с которым аутентификация не проходит")
+    args = parser.parse_args()
+
+    # Обрывы подключений клиентом - штатная ситуация для эмулятора
+    logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+    host_key = paramiko.RSAKey.generate(2048)
+    hostnames = {}
+    attributes = {}
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("0.0.0.0", args.port))
+    listener.listen(1024)
+    print(f"Fake ssh for {args.devices} devices on port {args.port}", flush=True)
+    while True:
+        sock, _ = listener.accept()
+        threading.Thread(target=handle_connection, args=(sock, host_key, hostnames, attributes, args), daemon=True).start()
+
+
+if __name__ == "__main__":
+    main()
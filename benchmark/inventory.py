@@ -0,0 +1,73 @@
+import random
+
+# Платформы синтетических устройств, как в platforms.json
+platforms = ["cisco", "eltex-mesos23", "eltex-mesos24", "eltex-esros", "qtech", "qsw33", "qsr"]
+# Префиксы имен, совпадают с name_regex в main.py
+name_prefixes = ["skd", "skr"]
+# Кол-во устройств на одной площадке
+devices_per_site = 20
+# Кол-во площадок в одном регионе
+sites_per_region = 10
+# Время последнего изменения всех синтетических устройств
+last_updated = "2024-01-01T00:00:00.000000Z"
+
+
+def index_to_ip(index):
+    """
+    Функция возвращает loopback адрес синтетического устройства.
+    Весь 127.0.0.0/8 доступен локально, поэтому один эмулятор ssh принимает подключения на все адреса,
+    а устройство определяется по адресу, на который пришло подключение.
+
+    Примеры:
+        >>> index_to_ip(0)
+        '127.1.0.0'
+
+        >>> index_to_ip(65537)
+        '127.2.0.1'
+    """
+    return f"127.{1 + index // 65536}.{(index // 256) % 256}.{index % 256}"
+
+
+def ip_to_index(ip):
+    """
+    Функция возвращает номер синтетического устройства по его адресу (обратная к index_to_ip).
+    """
+    _, second, third, fourth = (int(octet) for octet in ip.split("."))
+    return (second - 1) * 65536 + third * 256 + fourth
+
+
+def synthetic_device(index, seed=0, drift_rate=0.1, platform_error_rate=0.0):
+    """
+    Функция детерминированно генерирует синтетическое устройство по его номеру.
+    Одинаковые index, seed и drift_rate дают одинаковое устройство в эмуляторе NetBox и в эмуляторе ssh.
+
+    Параметры:
+        index (int): Номер устройства.
+        seed (int, optional): Зерно генератора.
+        drift_rate (float, optional): Доля устройств, у которых hostname на железке отличается от NetBox.
+        platform_error_rate (float, optional): Доля устройств, у которых платформа в NetBox не задана или неверна.
+
+    Возвращает:
+        dict: Описание устройства: id, name, ip, platform, платформа в NetBox netbox_platform, site, region, role
+              и hostname на железке.
+    """
+    rng = random.Random(seed * 1_000_003 + index)
+    name = f"{name_prefixes[index % len(name_prefixes)]}{index:06d}-sw01"
+    site = index // devices_per_site
+    hostname = f"old-{name}" if rng.random() < drift_rate else name
+    platform = platforms[index % len(platforms)]
+    netbox_platform = platform
+    if rng.random() < platform_error_rate:
+        # Половина ошибок - платформа не задана, половина - задана чужая
+        netbox_platform = None if rng.random() < 0.5 else platforms[(index + 1) % len(platforms)]
+    return {
+        "id": index + 1,
+        "name": name,
+        "ip": index_to_ip(index),
+        "platform": platform,
+        "netbox_platform": netbox_platform,
+        "site": f"site{site:05d}",
+        "region": f"region{site // sites_per_region:04d}",
+        "role": "core" if index % devices_per_site == 0 else "access",
+        "hostname": hostname,
+    }
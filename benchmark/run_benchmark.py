@@ -0,0 +1,271 @@
+"""
+Бенчмарк конвейера синхронизации hostname на эмуляторах NetBox и ssh.
+Запускает fake_netbox.py и fake_ssh.py отдельными процессами, прогоняет выгрузку инвентаря и обработку
+устройств из main.py и выводит устройств в секунду, p95 длительности обработки устройства и пиковый RSS.
+Перед замером проверяет, что при отказе в аутентификации и обрыве соединения main.open_session отдает
+исходные исключения netmiko.
+
+Запуск:
+    python benchmark/run_benchmark.py --devices 1000 --workers 50
+    python benchmark/run_benchmark.py --devices 10000 --latency 0.1 --failure-rate 0.02 --output results.jsonl
+    python benchmark/run_benchmark.py --devices 1000 --bastion
+    python benchmark/run_benchmark.py --devices 1000 --site-max-sessions 2 --role-priority core
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+benchmark_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(benchmark_dir)
+sys.path.insert(0, repo_dir)
+
+import main  # noqa: E402
+from inventory import index_to_ip  # noqa: E402
+
+
+def free_port():
+    """
+    Функция возвращает свободный tcp порт на localhost.
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_port(port, timeout=60):
+    """
+    Функция ждет, пока на localhost не откроется порт.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f"Port {port} was not opened in {timeout} s")
+
+
+def start_emulators(args):
+    """
+    Функция запускает эмуляторы NetBox, ssh и, если нужно, jump host и возвращает их процессы и порты.
+    """
+    netbox_port, ssh_port = free_port(), free_port()
+    common = ["--devices", str(args.devices), "--seed", str(args.seed), "--drift-rate", str(args.drift_rate)]
+    netbox = subprocess.Popen([sys.executable, os.path.join(benchmark_dir, "fake_netbox.py"),
+                               "--port", str(netbox_port), "--latency", str(args.netbox_latency),
+                               "--platform-error-rate", str(args.platform_error_rate)] + common,
+                              stdout=subprocess.DEVNULL)
+    ssh = subprocess.Popen([sys.executable, os.path.join(benchmark_dir, "fake_ssh.py"),
+                            "--port", str(ssh_port), "--latency", str(args.latency), "--jitter", str(args.jitter),
+                            "--save-factor", str(args.save_factor), "--failure-rate", str(args.failure_rate)] + common,
+                           stdout=subprocess.DEVNULL)
+    processes = [netbox, ssh]
+    bastion_port = None
+    if args.bastion:
+        bastion_port = free_port()
+        processes.append(subprocess.Popen([sys.executable, os.path.join(benchmark_dir, "fake_bastion.py"),
+                                           "--port", str(bastion_port)], stdout=subprocess.DEVNULL))
+        wait_port(bastion_port)
+    wait_port(netbox_port)
+    wait_port(ssh_port)
+    return processes, netbox_port, ssh_port, bastion_port
+
+
+def connect_error(ip, port, password):
+    """
+    Функция открывает сессию main.open_session к устройству эмулятора и возвращает исключение,
+    с которым она не открылась, или None.
+    """
+    main.ssh_port = port
+    try:
+        with main.open_session(ip, "benchmark", password, main.platform_profiles["cisco"], {}):
+            return None
+    except Exception as e:
+        return e
+
+
+def check_failure_paths(ssh_port):
+    """
+    Функция проверяет, что open_session отдает исходные исключения netmiko при отказе в аутентификации
+    и при обрыве соединения до ssh handshake. open_session вызывает внутренние методы netmiko, поэтому
+    проверка выполняется перед каждым замером. При ошибке выбрасывается RuntimeError.
+    """
+    # Обрыв соединения: сервер принимает tcp подключение и сразу закрывает его
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(8)
+
+    def drop():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            conn.close()
+
+    threading.Thread(target=drop, daemon=True).start()
+    try:
+        error = connect_error("127.0.0.1", listener.getsockname()[1], "benchmark")
+    finally:
+        listener.close()
+    if not main.is_transient_error(error):
+        raise RuntimeError(f"Dropped connection is not reported as a transient error: {error!r}")
+
+    # Отказ в аутентификации: эмулятор ssh не принимает пароль invalid. При --failure-rate подключение
+    # может оборваться раньше, тогда попытка повторяется
+    for _ in range(20):
+        error = connect_error(index_to_ip(0), ssh_port, "invalid")
+        if not main.is_transient_error(error):
+            break
+    if not isinstance(error, main.NetmikoAuthenticationException):
+        raise RuntimeError(f"Rejected login is not reported as an authentication error: {error!r}")
+
+
+def git_revision():
+    """
+    Функция возвращает текущий коммит репозитория, чтобы результаты разных версий можно было сравнить.
+    """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=repo_dir, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args, netbox_port, ssh_port, bastion_port, work_dir):
+    """
+    Функция прогоняет выгрузку инвентаря и обработку всех устройств и возвращает результаты замеров.
+    """
+    main.ssh_port = ssh_port
+    main.max_workers = args.workers
+    main.cache_db_file = os.path.join(work_dir, "benchmark.sqlite")
+    main.inventory_cache = False
+    main.verified_cache = False
+    main.prescan = args.prescan
+    main.timings_file = None
+    # Отказы эмулятора случайны, повтор с паузой только растянул бы замер
+    main.retry_max_attempts = 1
+    main.metrics_file = None
+    main.autodetect_platform = args.autodetect
+    main.platform_report_file = None
+    main.bastion_host = "127.0.0.1" if bastion_port else None
+    main.bastion_port = bastion_port
+    # Эмулятор jump host генерирует новый ключ при каждом запуске
+    main.bastion_known_hosts = os.path.join(work_dir, "known_hosts")
+    main.bastion_trust_on_first_use = True
+    main.site_scheduler = (args.site_max_sessions is not None or args.region_max_sessions is not None
+                           or bool(args.role_priority))
+    main.site_max_sessions = args.site_max_sessions
+    main.region_max_sessions = args.region_max_sessions
+    main.role_priority = args.role_priority
+    netbox_url = f"http://127.0.0.1:{netbox_port}"
+    # Ошибки устройств не пишутся в error.log и не выводятся в консоль
+    logging.getLogger().addHandler(logging.NullHandler())
+
+    metrics = main.RunMetrics()
+    start = time.perf_counter()
+    devices_dict = main.get_devices(netbox_url, "benchmark", main.name_regex)
+    inventory_seconds = time.perf_counter() - start
+    unreachable = {}
+    if args.prescan:
+        db = main.open_cache_db()
+        devices_dict, unreachable = main.split_unreachable(devices_dict, db)
+        db.close()
+    bastion = main.BastionPool("benchmark", "benchmark") if bastion_port else None
+    db = main.open_cache_db()
+    detector = main.PlatformDetector(db) if args.autodetect else None
+    devices = devices_dict.items()
+    if main.site_scheduler:
+        devices = main.add_attributes(devices, netbox_url, "benchmark")
+    with contextlib.redirect_stdout(io.StringIO()):
+        summary = main.run_sync(devices, "benchmark", "benchmark", total=len(devices_dict),
+                                metrics=metrics, bastion=bastion, detector=detector)
+    db.close()
+    if bastion is not None:
+        bastion.close()
+    total_seconds = time.perf_counter() - start
+    summary["unreachable"] = len(unreachable)
+
+    durations = sorted(value for (_, phase), values in metrics.samples.items() if phase == "total"
+                       for value in values)
+    processed = len(devices_dict) + len(unreachable)
+    return {
+        "revision": git_revision(),
+        "devices": args.devices,
+        "workers": args.workers,
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "failure_rate": args.failure_rate,
+        "bastion": args.bastion,
+        "platform_error_rate": args.platform_error_rate,
+        "autodetect": args.autodetect,
+        "site_max_sessions": args.site_max_sessions,
+        "region_max_sessions": args.region_max_sessions,
+        "role_priority": args.role_priority,
+        "inventory_seconds": round(inventory_seconds, 3),
+        "total_seconds": round(total_seconds, 3),
+        "devices_per_second": round(processed / total_seconds, 2) if total_seconds else None,
+        "p50_device_seconds": round(main.RunMetrics.quantile(durations, 0.5), 3) if durations else None,
+        "p95_device_seconds": round(main.RunMetrics.quantile(durations, 0.95), 3) if durations else None,
+        # ru_maxrss в Linux в килобайтах
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "summary": summary,
+    }
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description="Бенчмарк синхронизации hostname на эмуляторах NetBox и ssh")
+    parser.add_argument("--devices", type=int, default=1000, help="кол-во устройств (1000, 10000, 100000)")
+    parser.add_argument("--workers", type=int, default=main.max_workers, help="max_workers")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--drift-rate", type=float, default=0.1,
+                        help="доля устройств, у которых hostname на железке отличается от NetBox")
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка ответа устройства на команду, секунд")
+    parser.add_argument("--jitter", type=float, default=0.02, help="разброс задержки ответа устройства, секунд")
+    parser.add_argument("--save-factor", type=float, default=10.0,
+                        help="во сколько раз сохранение конфигурации дольше обычной команды")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="доля подключений, которые сразу рвутся")
+    parser.add_argument("--netbox-latency", type=float, default=0.05, help="задержка ответа API NetBox, секунд")
+    parser.add_argument("--prescan", action="store_true", help="включить проверку доступности перед ssh")
+    parser.add_argument("--bastion", action="store_true", help="подключаться к устройствам через эмулятор jump host")
+    parser.add_argument("--platform-error-rate", type=float, default=0.0,
+                        help="доля устройств, у которых платформа в NetBox не задана или неверна")
+    parser.add_argument("--autodetect", choices=["unknown", "all"], help="включить автоопределение платформы")
+    parser.add_argument("--site-max-sessions", type=int,
+                        help="включить планировщик по площадкам с ограничением сессий на площадку")
+    parser.add_argument("--region-max-sessions", type=int,
+                        help="включить планировщик по площадкам с ограничением сессий на регион")
+    parser.add_argument("--role-priority", nargs="*", default=[],
+                        help="включить планировщик по площадкам с приоритетом ролей (например core)")
+    parser.add_argument("--output", help="файл, в который дописывается результат в формате json lines")
+    args = parser.parse_args()
+
+    processes, netbox_port, ssh_port, bastion_port = start_emulators(args)
+    try:
+        check_failure_paths(ssh_port)
+        with tempfile.TemporaryDirectory() as work_dir:
+            result = run(args, netbox_port, ssh_port, bastion_port, work_dir)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+    for key, value in result.items():
+        print(f"{key}: {value}")
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as f:
+            f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main_benchmark()
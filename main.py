@@ -1,36 +1,162 @@
+import argparse
+import asyncio
+import csv
 import logging
 import getpass
+import hashlib
+import heapq
+import hmac
+import itertools
+import json
+import math
+import os
 import re
-from netmiko import ConnectHandler
+import socket
+import sqlite3
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager, nullcontext
+from netmiko import ConnectHandler, NetmikoAuthenticationException, NetmikoTimeoutException, ReadTimeout
+from paramiko import AutoAddPolicy, RejectPolicy, SSHClient
+from paramiko.ssh_exception import SSHException
 from pynetbox import api
 
 netbox_url = "https://netbox.example.ru"
 # Regex для поиска устройств согласно шаблона не учитывая регистр
 name_regex = [re.compile(r"^skd.*", re.IGNORECASE),
               re.compile(r"^skr.*", re.IGNORECASE)]
-# Включение логирования ssh сессий для платформы
-enable_cisco_sessions_log = False
-enable_mes23_sessions_log = False
-enable_mes24_sessions_log = False
-enable_esr_sessions_log = False
-enable_qsw46_sessions_log = False
-enable_qsw33_sessions_log = False
-enable_qsr_sessions_log = False
-# Название платформ, как в NetBox
-cisco = "cisco"
-mes23 = "eltex-mesos23"
-mes24 = "eltex-mesos24"
-esr = "eltex-esros"
-qtech46 = "qtech"
-qtech33 = "qsw33"
-qsr = "qsr"
-username = input("Enter your device login: ")
-password = getpass.getpass("Enter your device password: ")
-netbox_token = getpass.getpass("Enter your NetBox TOKEN: ")
-
-
-logging.basicConfig(filename='error.log', filemode='w', level=logging.ERROR, format='%(asctime)s - %(message)s',
-                    datefmt='%Y-%m-%d %H:%M:%S')
+# Размер страницы при выгрузке устройств из NetBox
+netbox_page_size = 1000
+# Параллельная выгрузка страниц из NetBox
+netbox_threading = True
+# Набор полей устройства, запрашиваемых из NetBox (NetBox 4.0+). None - запрашивать все поля
+netbox_fields = "id,name,primary_ip,platform,site,role"
+# Потоковый режим: устройства отдаются в обработку сразу по мере загрузки страниц из NetBox
+stream_inventory = False
+# Файл локальной базы sqlite для кэшей
+cache_db_file = "hostname_sync.sqlite"
+# Локальный кэш инвентаря: из NetBox догружаются только устройства, измененные с прошлой синхронизации
+inventory_cache = False
+# Через сколько секунд кэш инвентаря полностью перезагружается из NetBox
+inventory_cache_max_age = 24 * 60 * 60
+# Кэш проверенных устройств: устройство пропускается, если его hostname уже проверялся с тем же именем в NetBox
+verified_cache = False
+# Сколько секунд результат проверки hostname считается актуальным
+verified_ttl = 7 * 24 * 60 * 60
+# Порт ssh на устройствах
+ssh_port = 22
+# Быстрая проверка доступности ssh порта всех устройств перед ssh сессиями (кроме потокового режима)
+prescan = True
+# Таймаут проверки доступности ssh порта, секунд
+prescan_timeout = 2
+# Максимальное кол-во одновременных проверок доступности
+prescan_concurrency = 500
+# Сколько секунд недоступное устройство считается недоступным без повторной проверки (0 - не запоминать)
+unreachable_ttl = 15 * 60
+# Атрибуты конфигурации, которые сверяются с NetBox за одну ssh сессию: hostname, domain_name, snmp_location
+# (адрес площадки в NetBox, а если он не задан - название площадки) и snmp_contact.
+# Команды чтения и изменения атрибутов задаются в профилях платформ
+managed_attributes = ["hostname"]
+# Домен (domain_name) для всех устройств
+domain_name = None
+# snmp contact для устройств, у площадки которых в NetBox не задан custom field snmp_contact
+snmp_contact = None
+# Автоопределение платформы по выводу autodetect_command и fingerprint профилей платформ:
+# None - выключено, "unknown" - только для устройств без платформы в NetBox или с неизвестной платформой,
+# "all" - для всех устройств (платформа из NetBox проверяется). Результат запоминается per ip
+autodetect_platform = None
+# Команда, по выводу которой определяется платформа
+autodetect_command = "show version"
+# Тип устройства netmiko для сессии автоопределения
+autodetect_device_type = "cisco_ios"
+# Через сколько секунд определенная платформа определяется заново
+autodetect_ttl = 30 * 24 * 60 * 60
+# Отчет об устройствах, у которых платформа в NetBox не совпадает с определенной
+platform_report_file = "platform_mismatch.csv"
+# Jump host, через который доступны устройства (None - устройства доступны напрямую)
+bastion_host = None
+bastion_port = 22
+# Логин и ключ для jump host (None - логин от устройств и ключи из ssh agent и ~/.ssh, затем пароль от устройств)
+bastion_username = None
+bastion_key_file = None
+# Файл известных ключей jump host в дополнение к ~/.ssh/known_hosts (None - только ~/.ssh/known_hosts).
+# Подключение к jump host с неизвестным ключом отклоняется
+bastion_known_hosts = None
+# Принять неизвестный ключ jump host при первом подключении и сохранить его в bastion_known_hosts
+bastion_trust_on_first_use = False
+# Кол-во ssh подключений к jump host, по которым распределяются сессии к устройствам
+bastion_pool_size = 4
+# Таймаут установки tcp соединения с устройством, секунд
+conn_timeout = 10
+# Таймаут ожидания ответа устройства на команду, секунд. При адаптивных таймаутах - верхняя граница
+timeout_max = 30
+# Адаптивные таймауты: подключение и ожидание ответа ограничиваются по статистике прошлых запусков
+# per device (или per platform, если по устройству мало замеров)
+adaptive_timeouts = False
+# Перцентиль прошлых замеров, от которого считается таймаут
+timeout_percentile = 0.95
+# Во сколько раз таймаут больше перцентиля
+timeout_margin = 3
+# Нижняя граница адаптивного таймаута, секунд
+timeout_min = 2
+# Минимальное кол-во замеров, по которым считается таймаут
+timeout_min_samples = 5
+# Сколько последних замеров хранится per device и per platform
+timeout_device_history = 10
+timeout_platform_history = 200
+# Файл с длительностью этапов обработки каждого устройства в формате json lines (None - не писать)
+timings_file = "timings.jsonl"
+# Файл с метриками для textfile collector node_exporter (None - не писать)
+metrics_file = "hostname_sync.prom"
+# Границы бакетов гистограмм длительности этапов, секунд
+metrics_buckets = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+# Журнал запуска: итог по каждому устройству пишется сразу, прерванный запуск продолжается с ключом --resume
+journal_file = "run_journal.jsonl"
+# Сколько всего попыток делается для устройства при временной ошибке (таймаут, обрыв соединения)
+retry_max_attempts = 3
+# Пауза перед первой повторной попыткой, секунд. Каждая следующая пауза вдвое больше
+retry_base_delay = 30
+# Запись результата по каждому устройству в custom fields устройства в NetBox (нужен токен с правами на запись)
+netbox_writeback = False
+# Кол-во устройств в одном bulk PATCH запросе к NetBox
+netbox_writeback_batch = 200
+# Custom fields устройства в NetBox: время последней успешной проверки, последнего изменения hostname
+# и последняя ошибка
+writeback_fields = {
+    "last_verified": "hostname_sync_last_verified",
+    "last_changed": "hostname_sync_last_changed",
+    "last_error": "hostname_sync_last_error",
+}
+# Файл отчета о расхождениях hostname (режимы --plan и --apply), .json или .csv
+plan_file = "hostname_plan.json"
+# Максимальное кол-во одновременных ssh сессий в режиме --plan (только чтение, поэтому больше max_workers)
+plan_max_workers = 200
+# Адрес и порт, на которых сервис (--daemon) принимает webhook NetBox
+daemon_listen = ("127.0.0.1", 8081)
+# Секрет webhook в NetBox для проверки подписи X-Hook-Signature (None - подпись не проверяется)
+webhook_secret = None
+# Через сколько секунд после последнего события по устройству оно обрабатывается (события за это время склеиваются)
+daemon_debounce = 10
+# Максимальная задержка обработки устройства, если события по нему идут непрерывно, секунд
+daemon_debounce_max = 60
+# Как часто сервис выполняет полную проверку всех устройств, секунд
+daemon_full_sweep_interval = 24 * 60 * 60
+# Планировщик по площадкам: устройства выдаются в обработку по кругу по площадкам NetBox, а не подряд
+# по одной площадке. Весь список устройств при этом загружается до начала обработки
+site_scheduler = False
+# Максимальное кол-во одновременных ssh сессий на одну площадку и на один регион NetBox (None - без ограничения)
+site_max_sessions = 5
+region_max_sessions = None
+# Роли устройств в NetBox (slug), которые обрабатываются раньше остальных, по порядку приоритета
+role_priority = []
+# Файл с профилями платформ (ключ - платформа, как в NetBox)
+platforms_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "platforms.json")
+# Максимальное кол-во одновременных ssh сессий
+max_workers = 50
 
 
 def remove_parentheses_substrings(s: str) -> str:
@@ -58,7 +184,119 @@ def remove_parentheses_substrings(s: str) -> str:
     return result
 
 
-def get_devices(nb_url, nb_token, device_name_regex):
+def regex_to_prefix(regex):
+    """
+    Функция пытается получить из регулярного выражения префикс имени устройства,
+    чтобы фильтр можно было выполнить на стороне NetBox (name__isw).
+
+    Параметры:
+        regex (re.Pattern): Регулярное выражение вида "^skd.*" или "^skd".
+
+    Возвращает:
+        str: Префикс имени, или None, если выражение сложнее простого префикса.
+
+    Примеры:
+        >>> regex_to_prefix(re.compile(r"^skd.*"))
+        'skd'
+
+        >>> regex_to_prefix(re.compile(r"^sk[dr].*")) is None
+        True
+    """
+    match = re.fullmatch(r"\^([\w-]+)(\.\*)?", regex.pattern)
+    if match:
+        return match.group(1)
+    return None
+
+
+def build_device_query(device_name_regex):
+    """
+    Функция формирует параметры запроса устройств к API NetBox.
+    Если все регулярные выражения являются простыми префиксами, фильтр по имени выполняется на стороне NetBox.
+
+    Параметры:
+        device_name_regex (list of re.Pattern): Список регулярных выражений для фильтрации имен устройств.
+
+    Возвращает:
+        dict: Параметры для nb.dcim.devices.filter().
+    """
+    query = {"status": "active", "has_primary_ip": True, "limit": netbox_page_size}
+    if netbox_fields:
+        query["fields"] = netbox_fields
+    prefixes = [regex_to_prefix(regex) for regex in device_name_regex]
+    if prefixes and None not in prefixes:
+        query["name__isw"] = prefixes
+    return query
+
+
+def device_record(device):
+    """
+    Функция преобразует объект устройства pynetbox в пару (ip, dev_info), как в словаре get_devices.
+
+    Параметры:
+        device (pynetbox.core.response.Record): Устройство из NetBox.
+
+    Возвращает:
+        tuple: (ip, dev_info), где dev_info - вложенный словарь с id в NetBox, площадкой, ролью, именем устройства
+               и его платформой.
+    """
+    # До NetBox 4 роль устройства называлась device_role. Отсутствующее поле у записи pynetbox
+    # запрашивается из API отдельным запросом, поэтому поля проверяются по словарю записи
+    fields = vars(device)
+    role = fields.get("role") or fields.get("device_role")
+    return device.primary_ip.address.split("/")[0], {
+        "netbox_id": device.id,
+        "site": device.site.slug if device.site else None,
+        "role": role.slug if role else None,
+        "device_platform": device.platform.slug if device.platform else None,
+        "device_name": remove_parentheses_substrings(device.name).lower()
+    }
+
+
+def iter_devices(nb_url, nb_token, device_name_regex, threading=False, filters=None):
+    """
+    Генератор получает активные устройства из NetBox постранично и отдает подходящие под регулярные выражения
+    сразу по мере загрузки страниц, не дожидаясь выгрузки всего списка.
+    Если все регулярные выражения являются простыми префиксами, фильтр по имени выполняется на стороне NetBox,
+    иначе выгружаются все активные устройства и фильтруются локально.
+
+    Параметры:
+        nb_url (str): URL для доступа к API NetBox.
+        nb_token (str): Токен для аутентификации в API NetBox.
+        device_name_regex (list of re.Pattern): Список регулярных выражений для фильтрации имен устройств.
+        threading (bool, optional): Параллельная выгрузка страниц. Все страницы загружаются до отдачи
+                                    первого устройства, поэтому для потоковой обработки должно быть False.
+        filters (dict, optional): Дополнительные фильтры запроса, например из stale_filters().
+
+    Возвращает:
+        generator: Пары (ip, dev_info), где dev_info - вложенный словарь с именем устройства и его платформой.
+    """
+    nb = api(url=nb_url, token=nb_token, threading=threading)
+    for device in nb.dcim.devices.filter(**build_device_query(device_name_regex), **(filters or {})):
+        for regex in device_name_regex:
+            if regex.match(device.name):
+                yield device_record(device)
+                break
+
+
+def stale_filters():
+    """
+    Функция возвращает наборы фильтров NetBox по custom fields из writeback_fields для устройств, которые нужно
+    проверить: ни разу не проверенные, проверенные раньше verified_ttl секунд назад и с ошибкой в прошлый раз.
+    Фильтры в одном запросе NetBox объединяет по И, поэтому каждый набор выгружается отдельным запросом.
+
+    Возвращает:
+        list of dict: Наборы фильтров для iter_devices.
+    """
+    last_verified = f"cf_{writeback_fields['last_verified']}"
+    stale_before = (datetime.now(timezone.utc) - timedelta(seconds=verified_ttl)).isoformat(timespec="seconds")
+    return [
+        {f"{last_verified}__empty": True},
+        {f"{last_verified}__lt": stale_before},
+        {f"cf_{writeback_fields['last_error']}__empty": False},
+    ]
+
+
+def get_devices(nb_url, nb_token, device_name_regex, stale_only=False):
     """
     Функция получает список активных устройств из NetBox, фильтрует их по регулярному выражению для имен устройств
     и возвращает вложенный словарь с IP-адресами устройств, их именами и платформами.
@@ -67,440 +305,1922 @@ def get_devices(nb_url, nb_token, device_name_regex):
         nb_url (str): URL для доступа к API NetBox.
         nb_token (str): Токен для аутентификации в API NetBox.
         device_name_regex (list of re.Pattern): Список регулярных выражений для фильтрации имен устройств.
+        stale_only (bool, optional): Только устройства, которые давно не проверялись или с ошибкой в прошлый раз,
+                                     по custom fields, которые пишет NetBoxWriteback.
 
     Возвращает:
         dict: Словарь, где ключи - IP-адреса устройств, а значения - вложенные словари с именем устройства
         и его платформой.
     """
-    nb = api(url=nb_url, token=nb_token)
-    devices = nb.dcim.devices.filter(status="active", has_primary_ip=True)
-    filtered_devices = {}
+    if not stale_only:
+        return dict(iter_devices(nb_url, nb_token, device_name_regex, threading=netbox_threading))
+    devices_dict = {}
+    for filters in stale_filters():
+        devices_dict.update(iter_devices(nb_url, nb_token, device_name_regex, threading=netbox_threading,
+                                         filters=filters))
+    return devices_dict
+
+
+def get_sites(nb_url, nb_token):
+    """
+    Функция получает из NetBox площадки: регион площадки и значения атрибутов, которые задаются площадкой
+    устройства: snmp_location - адрес площадки (physical_address), а если он не задан - название площадки,
+    snmp_contact - custom field площадки snmp_contact, если он есть.
+
+    Параметры:
+        nb_url (str): URL для доступа к API NetBox.
+        nb_token (str): Токен для аутентификации в API NetBox.
+
+    Возвращает:
+        dict: Словарь, где ключи - slug площадки, а значения - словари с регионом (slug) и атрибутами.
+    """
+    nb = api(url=nb_url, token=nb_token, threading=netbox_threading)
+    sites = {}
+    for site in nb.dcim.sites.filter(limit=netbox_page_size):
+        address = ", ".join(line.strip() for line in (site.physical_address or "").splitlines() if line.strip())
+        sites[site.slug] = {
+            "region": site.region.slug if site.region else None,
+            "snmp_location": address or site.name,
+            "snmp_contact": (site.custom_fields or {}).get("snmp_contact"),
+        }
+    return sites
+
+
+def add_attributes(devices, nb_url, nb_token):
+    """
+    Генератор добавляет к устройствам значения атрибутов из managed_attributes, с которыми сверяется конфигурация:
+    dev_info["attributes"], и регион площадки dev_info["region"] для ограничения сессий на регион.
+    Площадки запрашиваются из NetBox один раз и только если от них зависят атрибуты или включен
+    region_max_sessions. Атрибуты без значения (например, не задан domain_name) не сверяются.
+
+    Параметры:
+        devices (iterable): Пары (ip, dev_info).
+        nb_url (str): URL для доступа к API NetBox.
+        nb_token (str): Токен для аутентификации в API NetBox.
+
+    Возвращает:
+        generator: Пары (ip, dev_info) с ключами attributes и region в dev_info.
+    """
+    sites = None
+    if {"snmp_location", "snmp_contact"} & set(managed_attributes) or (site_scheduler and region_max_sessions):
+        sites = get_sites(nb_url, nb_token)
+    for ip, dev_info in devices:
+        site = (sites or {}).get(dev_info.get("site"), {})
+        values = {
+            "hostname": dev_info["device_name"],
+            "domain_name": domain_name,
+            "snmp_location": site.get("snmp_location"),
+            "snmp_contact": site.get("snmp_contact") or snmp_contact,
+        }
+        yield ip, dict(dev_info, region=site.get("region"),
+                       attributes={name: values[name] for name in managed_attributes if values.get(name)})
+
+
+def verified_key(dev_info):
+    """
+    Функция возвращает строку с ожидаемым состоянием устройства для кэша проверенных: имя устройства,
+    а при сверке нескольких атрибутов - значения всех атрибутов. При изменении любого из них в NetBox
+    устройство проверяется заново.
+    """
+    attributes = dev_info.get("attributes")
+    if not attributes or set(attributes) == {"hostname"}:
+        return dev_info["device_name"]
+    return json.dumps(attributes, sort_keys=True, ensure_ascii=False)
+
+
+def open_cache_db():
+    """
+    Функция открывает локальную базу sqlite с кэшами и создает таблицы, если их нет.
+
+    Возвращает:
+        sqlite3.Connection: Соединение с базой cache_db_file.
+    """
+    db = sqlite3.connect(cache_db_file)
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS inventory (
+            netbox_id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            ip TEXT NOT NULL,
+            site TEXT,
+            role TEXT,
+            device_platform TEXT,
+            device_name TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS sync_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS verified_state (
+            ip TEXT PRIMARY KEY,
+            device_name TEXT NOT NULL,
+            verified_at TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS latency_stats (
+            scope TEXT NOT NULL,
+            key TEXT NOT NULL,
+            samples TEXT NOT NULL,
+            PRIMARY KEY (scope, key)
+        );
+        CREATE TABLE IF NOT EXISTS unreachable (
+            ip TEXT PRIMARY KEY,
+            checked_at TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS detected_platform (
+            ip TEXT PRIMARY KEY,
+            device_name TEXT NOT NULL,
+            netbox_platform TEXT,
+            detected_platform TEXT,
+            detected_at TEXT NOT NULL
+        );
+    """)
+    # Колонки, добавленные в кэш инвентаря позже: в базе от прошлых версий они добавляются,
+    # а кэш перезагружается из NetBox полностью
+    columns = {row[1] for row in db.execute("PRAGMA table_info(inventory)")}
+    for column in ("site", "role"):
+        if column not in columns:
+            with db:
+                db.execute(f"ALTER TABLE inventory ADD COLUMN {column} TEXT")
+                db.execute("DELETE FROM sync_meta WHERE key = 'inventory_last_full_sync'")
+    return db
+
+
+def get_meta(db, key):
+    """
+    Функция возвращает значение служебного ключа из таблицы sync_meta или None.
+    """
+    row = db.execute("SELECT value FROM sync_meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def set_meta(db, key, value):
+    """
+    Функция сохраняет значение служебного ключа в таблицу sync_meta.
+    """
+    db.execute("INSERT OR REPLACE INTO sync_meta (key, value) VALUES (?, ?)", (key, value))
+
+
+def refresh_inventory_cache(db, nb_url, nb_token, device_name_regex):
+    """
+    Функция обновляет кэш инвентаря из NetBox.
+    При первом запуске, смене фильтра или по истечении inventory_cache_max_age кэш загружается полностью.
+    Иначе загружаются только устройства с last_updated после прошлой синхронизации, а удаленные,
+    деактивированные и потерявшие primary ip устройства убираются из кэша по списку актуальных id.
+    Изменение адреса объекта IP, площадки, платформы или роли не меняет last_updated устройства, поэтому
+    вместе со списком id запрашиваются primary ip устройств, а при изменении площадок, платформ или ролей
+    с прошлой синхронизации кэш загружается полностью.
+
+    Параметры:
+        db (sqlite3.Connection): Соединение с базой кэша.
+        nb_url (str): URL для доступа к API NetBox.
+        nb_token (str): Токен для аутентификации в API NetBox.
+        device_name_regex (list of re.Pattern): Список регулярных выражений для фильтрации имен устройств.
+    """
+    nb = api(url=nb_url, token=nb_token, threading=netbox_threading)
+    query = build_device_query(device_name_regex)
+    query_signature = json.dumps(query, sort_keys=True)
+    # Запас на расхождение часов с NetBox
+    sync_started = datetime.now(timezone.utc) - timedelta(minutes=5)
+    last_sync = get_meta(db, "inventory_last_sync")
+    last_full_sync = get_meta(db, "inventory_last_full_sync")
+
+    full_sync = (last_sync is None or last_full_sync is None
+                 or get_meta(db, "inventory_query") != query_signature
+                 or sync_started - datetime.fromisoformat(last_full_sync)
+                 > timedelta(seconds=inventory_cache_max_age))
+    if not full_sync:
+        full_sync = any(endpoint.count(last_updated__gte=last_sync)
+                        for endpoint in (nb.dcim.sites, nb.dcim.platforms, nb.dcim.device_roles))
+    if full_sync:
+        devices = nb.dcim.devices.filter(**query)
+    else:
+        devices = nb.dcim.devices.filter(**query, last_updated__gte=last_sync)
+
+    rows = []
     for device in devices:
-        for regex in device_name_regex:
-            if regex.match(device.name):
-                filtered_devices[device.primary_ip.address.split("/")[0]] = {
-                    "device_platform": device.platform.slug,
-                    "device_name": remove_parentheses_substrings(device.name).lower()
+        ip, dev_info = device_record(device)
+        rows.append((device.id, device.name, ip, dev_info["site"], dev_info["role"], dev_info["device_platform"],
+                     dev_info["device_name"]))
+
+    active_ips = {}
+    if not full_sync:
+        id_query = {key: value for key, value in query.items() if key != "fields"}
+        if netbox_fields:
+            id_query["fields"] = "id,primary_ip"
+        active_ips = {device.id: device.primary_ip.address.split("/")[0]
+                      for device in nb.dcim.devices.filter(**id_query)}
+
+    with db:
+        if full_sync:
+            db.execute("DELETE FROM inventory")
+        else:
+            db.execute("CREATE TEMP TABLE IF NOT EXISTS active_ids (netbox_id INTEGER PRIMARY KEY, ip TEXT)")
+            db.execute("DELETE FROM active_ids")
+            db.executemany("INSERT INTO active_ids (netbox_id, ip) VALUES (?, ?)", active_ips.items())
+            db.execute("DELETE FROM inventory WHERE netbox_id NOT IN (SELECT netbox_id FROM active_ids)")
+            ip_changed = db.execute("UPDATE inventory SET ip = (SELECT ip FROM active_ids "
+                                    "WHERE active_ids.netbox_id = inventory.netbox_id) "
+                                    "WHERE ip != (SELECT ip FROM active_ids "
+                                    "WHERE active_ids.netbox_id = inventory.netbox_id)").rowcount
+            if ip_changed:
+                print(f"Inventory cache: primary ip changed for {ip_changed} device(s)")
+        db.executemany("INSERT OR REPLACE INTO inventory (netbox_id, name, ip, site, role, device_platform, "
+                       "device_name) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        set_meta(db, "inventory_query", query_signature)
+        set_meta(db, "inventory_last_sync", sync_started.isoformat())
+        if full_sync:
+            set_meta(db, "inventory_last_full_sync", sync_started.isoformat())
+    print(f"Inventory cache {'loaded' if full_sync else 'updated'}: {len(rows)} device(s) from NetBox")
+
+
+def get_cached_devices(nb_url, nb_token, device_name_regex):
+    """
+    Функция обновляет локальный кэш инвентаря и возвращает из него словарь, как get_devices.
+
+    Параметры:
+        nb_url (str): URL для доступа к API NetBox.
+        nb_token (str): Токен для аутентификации в API NetBox.
+        device_name_regex (list of re.Pattern): Список регулярных выражений для фильтрации имен устройств.
+
+    Возвращает:
+        dict: Словарь, где ключи - IP-адреса устройств, а значения - вложенные словари с именем устройства
+        и его платформой.
+    """
+    db = open_cache_db()
+    try:
+        refresh_inventory_cache(db, nb_url, nb_token, device_name_regex)
+        filtered_devices = {}
+        for netbox_id, name, ip, site, role, platform, dev_name in db.execute(
+                "SELECT netbox_id, name, ip, site, role, device_platform, device_name FROM inventory "
+                "ORDER BY netbox_id"):
+            if any(regex.match(name) for regex in device_name_regex):
+                filtered_devices[ip] = {
+                    "netbox_id": netbox_id,
+                    "site": site,
+                    "role": role,
+                    "device_platform": platform,
+                    "device_name": dev_name
                 }
-    return filtered_devices
+        return filtered_devices
+    finally:
+        db.close()
 
 
-def change_hostname_cisco(cisco_ip_address, cisco_username, cisco_password, cisco_dev_name, cisco_session_log=None):
+def is_recently_verified(db, ip, dev_name):
     """
-    Функция меняет hostname железки, если оно не соответствует имени в netbox
+    Функция проверяет, что hostname устройства уже сверялся с тем же именем в NetBox не раньше verified_ttl назад.
 
     Параметры:
-        cisco_ip_address (str): ip address устройства.
-        cisco_username (str): Имя пользователя для устройства.
-        cisco_password (str): Пароль для устройства.
-        cisco_dev_name (str): Имя устройства в netbox
-        cisco_session_log (bool, optional): Включение/выключение логирования ssh сессий
+        db (sqlite3.Connection): Соединение с базой кэша.
+        ip (str): ip address устройства.
+        dev_name (str): Имя устройства в netbox или другое ожидаемое состояние из verified_key().
 
     Возвращает:
-        bool: True, если имя устройства было изменено.
-              False, если имя устройства уже соответствует имени в NetBox.
+        bool: True, если устройство можно не проверять.
     """
-    device_info = {
-        "device_type": "cisco_xe",
-        "ip": cisco_ip_address,
-        "username": cisco_username,
-        "password": cisco_password,
-        "read_timeout_override": 30,
-    }
-    if cisco_session_log:
-        device_info["session_log"] = f"{cisco_ip_address}.log"
+    row = db.execute("SELECT device_name, verified_at FROM verified_state WHERE ip = ?", (ip,)).fetchone()
+    if row is None or row[0] != dev_name:
+        return False
+    return datetime.now(timezone.utc) - datetime.fromisoformat(row[1]) < timedelta(seconds=verified_ttl)
 
-    net_connect = ConnectHandler(**device_info)
-    sh_cisco_hostname = net_connect.send_command("show running-config | include hostname")
-    sh_cisco_hostname = sh_cisco_hostname.split("\n")
-    for i in sh_cisco_hostname:
-        if i.startswith("hostname"):
-            sh_cisco_hostname = i[9::]
-            break
-    if cisco_dev_name != sh_cisco_hostname:
-        net_connect.send_config_set(f"hostname {cisco_dev_name}")
-        net_connect.send_command("write memory")
-        net_connect.disconnect()
+
+def save_verified(db, ip, dev_name):
+    """
+    Функция запоминает, что hostname устройства соответствует имени в NetBox на текущий момент.
+
+    Параметры:
+        db (sqlite3.Connection): Соединение с базой кэша.
+        ip (str): ip address устройства.
+        dev_name (str): Имя устройства в netbox.
+    """
+    with db:
+        db.execute("INSERT OR REPLACE INTO verified_state (ip, device_name, verified_at) VALUES (?, ?, ?)",
+                   (ip, dev_name, datetime.now(timezone.utc).isoformat()))
+
+
+async def is_port_open(ip, semaphore):
+    """
+    Функция проверяет, что на устройстве открыт ssh порт (устанавливается tcp соединение).
+
+    Параметры:
+        ip (str): ip address устройства.
+        semaphore (asyncio.Semaphore): Ограничение одновременных проверок.
+
+    Возвращает:
+        bool: True, если соединение установлено за prescan_timeout.
+    """
+    async with semaphore:
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(ip, ssh_port), prescan_timeout)
+        except (OSError, asyncio.TimeoutError):
+            return False
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
         return True
-    else:
-        net_connect.disconnect()
-        return False
 
 
-def change_hostname_mes23(mes23_ip_address, mes23_username, mes23_password, mes23_dev_name, mes23_session_log=None):
+async def scan_ports(ips):
     """
-    Функция меняет hostname железки, если оно не соответствует имени в netbox
+    Функция параллельно проверяет доступность ssh порта на списке устройств.
 
     Параметры:
-        mes23_ip_address (str): ip address устройства.
-        mes23_username (str): Имя пользователя для устройства.
-        mes23_password (str): Пароль для устройства.
-        mes23_dev_name (str): Имя устройства в netbox
-        mes23_session_log (bool, optional): Включение/выключение логирования ssh сессий
+        ips (list of str): ip address устройств.
 
     Возвращает:
-        bool: True, если имя устройства было изменено.
-              False, если имя устройства уже соответствует имени в NetBox.
+        dict: Словарь, где ключи - ip address, а значения - True, если порт доступен.
     """
-    device_info = {
-        "device_type": "eltex",
-        "ip": mes23_ip_address,
-        "username": mes23_username,
-        "password": mes23_password,
-        "read_timeout_override": 30,
-    }
-    if mes23_session_log:
-        device_info["session_log"] = f"{mes23_ip_address}.log"
+    semaphore = asyncio.Semaphore(prescan_concurrency)
+    results = await asyncio.gather(*(is_port_open(ip, semaphore) for ip in ips))
+    return dict(zip(ips, results))
 
-    net_connect = ConnectHandler(**device_info)
-    sh_mes23_hostname = net_connect.send_command("show running-config | include hostname")
-    sh_mes23_hostname = sh_mes23_hostname.split("\n")
-    for i in sh_mes23_hostname:
-        if i.startswith("hostname"):
-            sh_mes23_hostname = i[9::]
-            break
-    if mes23_dev_name != sh_mes23_hostname:
-        net_connect.send_config_set(f"hostname {mes23_dev_name}", cmd_verify=False)
-        wr_mem = net_connect.send_command_timing("write memory")
-        if "Overwrite file [startup-config]" in wr_mem:
-            wr_mem += net_connect.send_command_timing("Y")
-        net_connect.disconnect()
-        return True
-    else:
-        net_connect.disconnect()
-        return False
 
+def split_unreachable(devices_dict, db):
+    """
+    Функция отделяет устройства с недоступным ssh портом, чтобы не ждать на них таймаута ssh подключения.
+    Устройства, недоступные при прошлых запусках не раньше unreachable_ttl назад, повторно не проверяются.
+
+    Параметры:
+        devices_dict (dict): Словарь устройств из get_devices.
+        db (sqlite3.Connection): Соединение с базой кэша.
 
-def change_hostname_mes24(mes24_ip_address, mes24_username, mes24_password, mes24_dev_name, mes24_session_log=None):
+    Возвращает:
+        tuple: (reachable, unreachable) - словари устройств в формате devices_dict.
     """
-    Функция меняет hostname железки, если оно не соответствует имени в netbox
+    now = datetime.now(timezone.utc)
+    recently_unreachable = set()
+    for ip, checked_at in db.execute("SELECT ip, checked_at FROM unreachable"):
+        if now - datetime.fromisoformat(checked_at) < timedelta(seconds=unreachable_ttl):
+            recently_unreachable.add(ip)
+
+    to_scan = [ip for ip in devices_dict if ip not in recently_unreachable]
+    scanned = asyncio.run(scan_ports(to_scan))
+    with db:
+        db.executemany("DELETE FROM unreachable WHERE ip = ?", [(ip,) for ip, is_open in scanned.items() if is_open])
+        if unreachable_ttl:
+            db.executemany("INSERT OR REPLACE INTO unreachable (ip, checked_at) VALUES (?, ?)",
+                           [(ip, now.isoformat()) for ip, is_open in scanned.items() if not is_open])
+
+    reachable, unreachable = {}, {}
+    for ip, dev_info in devices_dict.items():
+        if scanned.get(ip):
+            reachable[ip] = dev_info
+        else:
+            unreachable[ip] = dev_info
+    return reachable, unreachable
+
+
+def iter_unique_devices(devices):
+    """
+    Генератор пропускает повторы ip, чтобы при потоковой обработке одно устройство
+    не обрабатывалось дважды (в словаре get_devices повтор ip просто перезаписывается).
 
     Параметры:
-        mes24_ip_address (str): ip address устройства.
-        mes24_username (str): Имя пользователя для устройства.
-        mes24_password (str): Пароль для устройства.
-        mes24_dev_name (str): Имя устройства в netbox
-        mes24_session_log (bool, optional): Включение/выключение логирования ssh сессий
+        devices (iterable): Пары (ip, dev_info).
 
     Возвращает:
-        bool: True, если имя устройства было изменено.
-              False, если имя устройства уже соответствует имени в NetBox.
+        generator: Пары (ip, dev_info) без повторов ip.
     """
-    device_info = {
-        "device_type": "eltex",
-        "ip": mes24_ip_address,
-        "username": mes24_username,
-        "password": mes24_password,
-        "read_timeout_override": 30,
-    }
-    if mes24_session_log:
-        device_info["session_log"] = f"{mes24_ip_address}.log"
+    seen = set()
+    for ip, dev_info in devices:
+        if ip not in seen:
+            seen.add(ip)
+            yield ip, dev_info
 
-    net_connect = ConnectHandler(**device_info)
-    net_connect.send_command("set cli pagination off")
-    sh_mes24_hostname = net_connect.send_command("show running-config | grep hostname")
-    sh_mes24_hostname = sh_mes24_hostname.split("\n")
-    for i in sh_mes24_hostname:
-        if i.startswith("hostname"):
-            sh_mes24_hostname = i[9::].replace('"','').strip()
-            break
-    if mes24_dev_name != sh_mes24_hostname:
-        net_connect.send_config_set(f"hostname {mes24_dev_name}", cmd_verify=False)
-        net_connect.send_command("write startup-config")
-        net_connect.disconnect()
-        return True
-    else:
-        net_connect.disconnect()
-        return False
+
+def load_platform_profiles(path):
+    """
+    Функция загружает профили платформ из json файла.
+    Профиль описывает все отличия платформы: device_type для netmiko, команды и regex для чтения hostname
+    и других атрибутов, команды конфигурации и сохранения, ограничения. Новая платформа добавляется в файл без правки кода.
+
+    Параметры:
+        path (str): Путь к json файлу с профилями.
+
+    Возвращает:
+        dict: Словарь, где ключи - платформы, как в NetBox, а значения - профили.
+    """
+    with open(path, encoding="utf-8") as f:
+        profiles = json.load(f)
+    for platform, profile in profiles.items():
+        missing = {"device_type", "hostname_command", "hostname_regex", "config_commands"} - profile.keys()
+        if missing:
+            raise ValueError(f"Platform profile {platform} in {path} has no {', '.join(sorted(missing))}")
+        profile.setdefault("session_log", False)
+        profile.setdefault("max_workers", None)
+        profile.setdefault("prompt_max_len", None)
+        profile.setdefault("pre_commands", [])
+        profile.setdefault("config_mode_command", None)
+        profile.setdefault("cmd_verify", True)
+        profile.setdefault("save", None)
+        profile.setdefault("commit_commands", [])
+        profile.setdefault("attributes_command", "show running-config")
+        profile.setdefault("attributes", {})
+        profile.setdefault("fingerprint", None)
+        profile["hostname_regex"] = re.compile(profile["hostname_regex"], re.MULTILINE)
+        if profile["fingerprint"]:
+            profile["fingerprint"] = re.compile(profile["fingerprint"])
+        for name, attribute in profile["attributes"].items():
+            if {"regex", "commands"} - attribute.keys():
+                raise ValueError(f"Attribute {name} of platform profile {platform} in {path} needs regex and commands")
+            attribute["regex"] = re.compile(attribute["regex"], re.MULTILINE)
+    return profiles
+
+
+# Профили платформ и семафоры для ограничения одновременных ssh сессий per platform
+platform_profiles = load_platform_profiles(platforms_file)
+platform_semaphores = {platform: threading.BoundedSemaphore(profile["max_workers"])
+                       for platform, profile in platform_profiles.items() if profile["max_workers"]}
 
 
-def change_hostname_esr(esr_ip_address, esr_username, esr_password, esr_dev_name, esr_session_log=None):
+def prompt_hostname(net_connect, profile):
     """
-    Функция меняет hostname железки, если оно не соответствует имени в netbox
+    Функция определяет hostname устройства по приглашению CLI, которое netmiko уже получил при подключении,
+    без выполнения show running-config.
 
     Параметры:
-        esr_ip_address (str): ip address устройства.
-        esr_username (str): Имя пользователя для устройства.
-        esr_password (str): Пароль для устройства.
-        esr_dev_name (str): Имя устройства в netbox
-        esr_session_log (bool, optional): Включение/выключение логирования ssh сессий
+        net_connect (netmiko.BaseConnection): Открытая ssh сессия.
+        profile (dict): Профиль платформы.
 
     Возвращает:
-        bool: True, если имя устройства было изменено.
-              False, если имя устройства уже соответствует имени в NetBox.
+        str: hostname из приглашения, или None, если приглашение могло быть обрезано или не похоже на hostname,
+             и hostname нужно читать из конфигурации.
     """
-    device_info = {
-        "device_type": "eltex_esr",
-        "ip": esr_ip_address,
-        "username": esr_username,
-        "password": esr_password,
-        "read_timeout_override": 30,
-    }
-    if esr_session_log:
-        device_info["session_log"] = f"{esr_ip_address}.log"
+    hostname = net_connect.base_prompt.strip()
+    max_len = profile["prompt_max_len"]
+    if not re.fullmatch(r"[\w.-]+", hostname) or (max_len and len(hostname) >= max_len):
+        return None
+    return hostname
 
-    net_connect = ConnectHandler(**device_info)
-    sh_esr_hostname = net_connect.send_command("show running-config | include hostname")
-    sh_esr_hostname = sh_esr_hostname.split("\n")
-    for i in sh_esr_hostname:
-        if i.startswith("hostname"):
-            sh_esr_hostname = i[9::]
-            break
-    if esr_dev_name != sh_esr_hostname:
-        net_connect.send_config_set([f"hostname {esr_dev_name}",
-                                     "do commit",
-                                     "do confirm",
-                                     "do save"])
-        net_connect.disconnect()
-        return True
-    else:
-        net_connect.disconnect()
-        return False
 
+def query_hostname(net_connect, profile):
+    """
+    Функция читает hostname устройства из конфигурации командой и regex из профиля платформы.
+
+    Параметры:
+        net_connect (netmiko.BaseConnection): Открытая ssh сессия.
+        profile (dict): Профиль платформы.
+
+    Возвращает:
+        str: hostname из конфигурации, или None, если строка hostname не найдена.
+    """
+    for command in profile["pre_commands"]:
+        net_connect.send_command(command)
+    match = profile["hostname_regex"].search(net_connect.send_command(profile["hostname_command"]))
+    return match.group(1) if match else None
 
-def change_hostname_qsw46(qsw46_ip_address, qsw46_username, qsw46_password, qsw46_dev_name, qsw46_session_log=None):
+
+def save_config(net_connect, save, read_timeout=timeout_max):
     """
-    Функция меняет hostname железки, если оно не соответствует имени в netbox
+    Функция сохраняет конфигурацию устройства.
+    Вместо ожидания по таймеру (send_command_timing) вывод читается до запроса подтверждения
+    или до приглашения CLI, поэтому функция возвращается сразу, как только устройство ответило.
 
     Параметры:
-        qsw46_ip_address (str): ip address устройства.
-        qsw46_username (str): Имя пользователя для устройства.
-        qsw46_password (str): Пароль для устройства.
-        qsw46_dev_name (str): Имя устройства в netbox
-        qsw46_session_log (bool, optional): Включение/выключение логирования ssh сессий
+        net_connect (netmiko.BaseConnection): Открытая ssh сессия.
+        save (dict): Команда сохранения из профиля платформы: command, confirm (regex запроса подтверждения
+                     или None) и answer (ответ на запрос).
+        read_timeout (float, optional): Таймаут ожидания ответа на команду сохранения, секунд.
 
     Возвращает:
-        bool: True, если имя устройства было изменено.
-              False, если имя устройства уже соответствует имени в NetBox.
+        str: Вывод команды сохранения.
     """
-    device_info = {
-        "device_type": "cisco_xe",
-        "ip": qsw46_ip_address,
-        "username": qsw46_username,
-        "password": qsw46_password,
-        "read_timeout_override": 30,
-    }
-    if qsw46_session_log:
-        device_info["session_log"] = f"{qsw46_ip_address}.log"
+    # Приглашение запрашивается заново, т.к. после смены hostname оно уже не совпадает с base_prompt
+    prompt = re.escape(net_connect.find_prompt().strip())
+    expect = f"{save['confirm']}|{prompt}" if save["confirm"] else prompt
+    output = net_connect.send_command(save["command"], expect_string=expect, read_timeout=read_timeout)
+    if save["confirm"] and re.search(save["confirm"], output):
+        output += net_connect.send_command(save["answer"], expect_string=prompt, cmd_verify=False,
+                                           read_timeout=read_timeout)
+    return output
 
-    net_connect = ConnectHandler(**device_info)
-    sh_qsw46_hostname = net_connect.send_command("show running-config | include hostname")
-    sh_qsw46_hostname = sh_qsw46_hostname.split("\n")
-    for i in sh_qsw46_hostname:
-        if i.startswith("hostname"):
-            sh_qsw46_hostname = i[9::]
-            break
-    if qsw46_dev_name != sh_qsw46_hostname:
-        net_connect.send_config_set(f"hostname {qsw46_dev_name}", config_mode_command="config terminal")
-        wr_mem = net_connect.send_command_timing("write running-config")
-        if "Confirm to overwrite current startup-config configuration [Y/N]:" in wr_mem:
-            wr_mem += net_connect.send_command_timing("Y")
-        net_connect.disconnect()
-        return True
-    else:
-        net_connect.disconnect()
-        return False
 
+@contextmanager
+def timed(timings, phase):
+    """
+    Контекстный менеджер добавляет длительность блока в секундах к этапу phase в словаре timings.
+    Длительность записывается и при исключении, чтобы было видно, на каком этапе ушло время до ошибки.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[phase] = timings.get(phase, 0) + time.perf_counter() - start
 
-def change_hostname_qsw33(qsw33_ip_address, qsw33_username, qsw33_password, qsw33_dev_name, qsw33_session_log=None):
+
+def close_session(net_connect):
     """
-    Функция меняет hostname железки, если оно не соответствует имени в netbox
+    Функция закрывает ssh сессию.
+    netmiko disconnect() для части платформ (например eltex) перед выходом проверяет режим конфигурации
+    чтением канала до 2 секунд тишины. send_config_set всегда выходит из режима конфигурации,
+    поэтому эта проверка не нужна: отправляется exit и соединение закрывается сразу.
+    Как и netmiko disconnect(), функция не выбрасывает исключений, чтобы не подменить ошибку сессии:
+    при неудачном подключении establish_connection уже сам закрыл соединение и удалил remote_conn_pre.
 
     Параметры:
-        qsw33_ip_address (str): ip address устройства.
-        qsw33_username (str): Имя пользователя для устройства.
-        qsw33_password (str): Пароль для устройства.
-        qsw33_dev_name (str): Имя устройства в netbox
-        qsw33_session_log (bool, optional): Включение/выключение логирования ssh сессий
+        net_connect (netmiko.BaseConnection): Открытая ssh сессия.
+    """
+    try:
+        net_connect.write_channel("exit" + net_connect.RETURN)
+    except Exception:
+        pass
+    try:
+        net_connect.paramiko_cleanup()
+    except Exception:
+        pass
+    try:
+        if net_connect.session_log:
+            net_connect.session_log.close()
+    except Exception:
+        pass
+
+
+class BastionPool:
+    """
+    Пул ssh подключений к jump host (bastion_host). Handshake и аутентификация на jump host выполняются
+    один раз на подключение, а сессия к каждому устройству открывается каналом direct-tcpip поверх одного
+    из bastion_pool_size подключений, которые раздаются потокам по кругу. Оборванное подключение
+    переподключается при следующем обращении к нему. Ключ jump host проверяется по ~/.ssh/known_hosts
+    и bastion_known_hosts до отправки пароля, неизвестный ключ принимается только
+    при bastion_trust_on_first_use.
+    """
+
+    def __init__(self, dev_username, dev_password):
+        self.username = bastion_username or dev_username
+        self.password = dev_password
+        self.clients = [None] * bastion_pool_size
+        self.locks = [threading.Lock() for _ in range(bastion_pool_size)]
+        self.counter = itertools.count()
+
+    def connect(self):
+        client = SSHClient()
+        client.load_system_host_keys()
+        if bastion_known_hosts:
+            if bastion_trust_on_first_use and not os.path.exists(bastion_known_hosts):
+                open(bastion_known_hosts, "a").close()
+            if os.path.exists(bastion_known_hosts):
+                # Принятый при первом подключении ключ сохраняется в этот же файл
+                client.load_host_keys(bastion_known_hosts)
+        client.set_missing_host_key_policy(AutoAddPolicy() if bastion_trust_on_first_use else RejectPolicy())
+        client.connect(bastion_host, port=bastion_port, username=self.username, password=self.password,
+                       key_filename=bastion_key_file, timeout=conn_timeout, banner_timeout=conn_timeout,
+                       auth_timeout=conn_timeout)
+        client.get_transport().set_keepalive(30)
+        return client
+
+    def open_channel(self, ip_address, port, timeout):
+        """
+        Открывает канал до порта устройства через jump host. Канал передается в netmiko вместо tcp сокета.
+
+        Возвращает:
+            paramiko.Channel: Канал direct-tcpip.
+        """
+        index = next(self.counter) % len(self.clients)
+        with self.locks[index]:
+            client = self.clients[index]
+            if client is None or not client.get_transport() or not client.get_transport().is_active():
+                if client is not None:
+                    client.close()
+                client = self.clients[index] = self.connect()
+        return client.get_transport().open_channel("direct-tcpip", (ip_address, port), ("127.0.0.1", 0),
+                                                   timeout=timeout)
+
+    def close(self):
+        for client in self.clients:
+            if client is not None:
+                client.close()
+
+
+@contextmanager
+def open_session(ip_address, dev_username, dev_password, profile, timings, timeouts=None, bastion=None):
+    """
+    Контекстный менеджер открывает ssh сессию к устройству и закрывает ее при выходе из блока.
+    Подключение выполняется по этапам, длительность каждого пишется в timings: tcp_connect (при работе через
+    jump host - открытие канала), ssh_auth, prompt_discovery и disconnect.
+
+    Параметры:
+        ip_address (str): ip address устройства.
+        dev_username (str): Имя пользователя для устройства.
+        dev_password (str): Пароль для устройства.
+        profile (dict): Профиль платформы устройства.
+        timings (dict): Словарь, в который пишется длительность этапов.
+        timeouts (dict, optional): Таймауты из LatencyStats.timeouts(): conn, auth и read, секунд.
+                                   Без них используются conn_timeout и timeout_max.
+        bastion (BastionPool, optional): Пул подключений к jump host. None - подключение напрямую.
 
     Возвращает:
-        bool: True, если имя устройства было изменено.
-              False, если имя устройства уже соответствует имени в NetBox.
+        netmiko.BaseConnection: Открытая ssh сессия.
     """
+    if timeouts is None:
+        timeouts = {}
     device_info = {
-        "device_type": "cisco_xe",
-        "ip": qsw33_ip_address,
-        "username": qsw33_username,
-        "password": qsw33_password,
-        "read_timeout_override": 30,
+        "device_type": profile["device_type"],
+        "ip": ip_address,
+        "username": dev_username,
+        "password": dev_password,
+        "port": ssh_port,
+        "conn_timeout": timeouts.get("conn", conn_timeout),
+        "read_timeout_override": timeouts.get("read", timeout_max),
+        # Подключение выполняется по этапам ниже, чтобы замерить каждый из них
+        "auto_connect": False,
     }
-    if qsw33_session_log:
-        device_info["session_log"] = f"{qsw33_ip_address}.log"
+    if "auth" in timeouts:
+        device_info["auth_timeout"] = timeouts["auth"]
+        device_info["banner_timeout"] = timeouts["auth"]
+    if profile["session_log"]:
+        device_info["session_log"] = f"{ip_address}.log"
 
+    with timed(timings, "tcp_connect"):
+        if bastion is not None:
+            device_info["sock"] = bastion.open_channel(ip_address, ssh_port, device_info["conn_timeout"])
+        else:
+            device_info["sock"] = socket.create_connection((ip_address, ssh_port),
+                                                           timeout=device_info["conn_timeout"])
     net_connect = ConnectHandler(**device_info)
-    sh_qsw33_hostname = net_connect.send_command("show running-config | include hostname")
-    sh_qsw33_hostname = sh_qsw33_hostname.split("\n")
-    for i in sh_qsw33_hostname:
-        if i.startswith("hostname"):
-            sh_qsw33_hostname = i[9::].replace('"','').strip()
-            break
-    if qsw33_dev_name != sh_qsw33_hostname:
-        net_connect.send_config_set(f"hostname {qsw33_dev_name}")
-        wr_mem = net_connect.send_command_timing("write memory")
-        if "Are you sure you want to save?" in wr_mem:
-            wr_mem += net_connect.send_command_timing("Y")
-        net_connect.disconnect()
-        return True
-    else:
-        net_connect.disconnect()
+    # Этапы повторяют BaseConnection.__init__ netmiko при auto_connect=True и вызывают его внутренние методы
+    # (_modify_connection_params, _try_session_preparation), поэтому зависят от версии netmiko (в Pipfile 4.2.0).
+    # При обновлении netmiko прогнать benchmark/run_benchmark.py: он проверяет, что отказ в аутентификации
+    # и обрыв соединения приходят отсюда исходными исключениями
+    try:
+        with timed(timings, "ssh_auth"):
+            net_connect._modify_connection_params()
+            net_connect.establish_connection()
+        with timed(timings, "prompt_discovery"):
+            net_connect._try_session_preparation()
+        yield net_connect
+    finally:
+        # Ошибки закрытия не выбрасываются, поэтому наружу уходит исходное исключение сессии
+        with timed(timings, "disconnect"):
+            close_session(net_connect)
+            try:
+                device_info["sock"].close()
+            except Exception:
+                pass
+
+
+def read_hostname(net_connect, profile):
+    """
+    Функция возвращает текущий hostname устройства: из приглашения CLI, а если по нему hostname
+    определить нельзя - из конфигурации.
+    """
+    hostname = prompt_hostname(net_connect, profile)
+    if hostname is None:
+        hostname = query_hostname(net_connect, profile)
+    return hostname
+
+
+def read_attributes(net_connect, profile, names):
+    """
+    Функция читает текущие значения атрибутов устройства. Если сверяется только hostname, он берется
+    из приглашения CLI или командой hostname_command. Иначе все атрибуты читаются из вывода одной команды
+    attributes_command профиля регулярками hostname_regex и attributes.<атрибут>.regex.
+
+    Параметры:
+        net_connect (netmiko.BaseConnection): Открытая ssh сессия.
+        profile (dict): Профиль платформы.
+        names (list of str): Атрибуты, например ["hostname", "snmp_location"].
+
+    Возвращает:
+        dict: Текущие значения атрибутов, None - атрибут в конфигурации не задан.
+    """
+    if set(names) == {"hostname"}:
+        return {"hostname": read_hostname(net_connect, profile)}
+    for command in profile["pre_commands"]:
+        net_connect.send_command(command)
+    output = net_connect.send_command(profile["attributes_command"])
+    current = {}
+    for name in names:
+        regex = profile["hostname_regex"] if name == "hostname" else profile["attributes"][name]["regex"]
+        match = regex.search(output)
+        current[name] = match.group(1) if match else None
+    return current
+
+
+def attribute_commands(profile, name, value):
+    """
+    Функция возвращает команды изменения атрибута из профиля платформы. В командах hostname значение
+    подставляется вместо {name}, в командах остальных атрибутов - вместо {value}.
+    """
+    if name == "hostname":
+        return [command.format(name=value) for command in profile["config_commands"]]
+    return [command.format(value=value) for command in profile["attributes"][name]["commands"]]
+
+
+def reconcile_device(ip_address, dev_username, dev_password, desired, profile, timings=None, timeouts=None,
+                     bastion=None, read_only=False):
+    """
+    Функция сверяет атрибуты конфигурации железки со значениями из netbox и меняет отличающиеся
+    за одну ssh сессию: одно чтение конфигурации, одна отправка команд всех атрибутов и одно сохранение.
+
+    Параметры:
+        ip_address (str): ip address устройства.
+        dev_username (str): Имя пользователя для устройства.
+        dev_password (str): Пароль для устройства.
+        desired (dict): Значения атрибутов из netbox, например {"hostname": "skd-sw01"}.
+        profile (dict): Профиль платформы устройства.
+        timings (dict, optional): Словарь, в который пишется длительность этапов: tcp_connect, ssh_auth,
+                                  prompt_discovery, hostname_query, config_push, save, disconnect.
+        timeouts (dict, optional): Таймауты из LatencyStats.timeouts(): conn, auth, read и write, секунд.
+                                   Без них используются conn_timeout и timeout_max.
+        bastion (BastionPool, optional): Пул подключений к jump host.
+        read_only (bool, optional): Только прочитать атрибуты, без входа в режим конфигурации (режим plan).
+
+    Возвращает:
+        tuple: (current, drift) - текущие значения атрибутов на устройстве и список атрибутов, которые
+               отличались от netbox (и были изменены, если не read_only).
+    """
+    if timings is None:
+        timings = {}
+    with open_session(ip_address, dev_username, dev_password, profile, timings, timeouts,
+                      bastion) as net_connect:
+        with timed(timings, "hostname_query"):
+            current = read_attributes(net_connect, profile, list(desired))
+        drift = [name for name, value in desired.items() if current.get(name) != value]
+        if read_only or not drift:
+            return current, drift
+        commands = [command for name in drift for command in attribute_commands(profile, name, desired[name])]
+        # Конфигурирование и сохранение заметно дольше чтения, поэтому таймаут чтения сессии к ним
+        # не применяется: таймаут берется по статистике этапов записи или равен timeout_max
+        write_timeout = (timeouts or {}).get("write", timeout_max)
+        net_connect.read_timeout_override = None
+        config_kwargs = {"cmd_verify": profile["cmd_verify"], "read_timeout": write_timeout}
+        if profile["config_mode_command"]:
+            config_kwargs["config_mode_command"] = profile["config_mode_command"]
+        with timed(timings, "config_push"):
+            net_connect.send_config_set(commands + profile["commit_commands"], **config_kwargs)
+        if profile["save"]:
+            with timed(timings, "save"):
+                save_config(net_connect, profile["save"], write_timeout)
+        return current, drift
+
+
+def detect_platform(ip_address, dev_username, dev_password, timeouts=None, bastion=None):
+    """
+    Функция определяет платформу устройства: выполняет autodetect_command и ищет в выводе fingerprint профилей
+    платформ по порядку их следования в platforms.json.
+    netmiko SSHDetect не используется: он не знает eltex и qtech и не различает профили с одним device_type.
+
+    Параметры:
+        ip_address (str): ip address устройства.
+        dev_username (str): Имя пользователя для устройства.
+        dev_password (str): Пароль для устройства.
+        timeouts (dict, optional): Таймауты из LatencyStats.timeouts().
+        bastion (BastionPool, optional): Пул подключений к jump host.
+
+    Возвращает:
+        str: Платформа, как в platforms.json, или None, если вывод не подошел ни под один fingerprint.
+    """
+    profile = {"device_type": autodetect_device_type, "session_log": False}
+    with open_session(ip_address, dev_username, dev_password, profile, {}, timeouts, bastion) as net_connect:
+        output = net_connect.send_command(autodetect_command)
+    for platform, platform_profile in platform_profiles.items():
+        if platform_profile["fingerprint"] and platform_profile["fingerprint"].search(output):
+            return platform
+    return None
+
+
+def is_transient_error(error):
+    """
+    Функция определяет, что ошибка временная и устройство имеет смысл попробовать еще раз:
+    таймауты, обрывы и отказы соединения. Ошибка аутентификации временной не считается.
+
+    Параметры:
+        error (Exception): Исключение при обработке устройства.
+
+    Возвращает:
+        bool: True, если ошибка временная.
+    """
+    if isinstance(error, NetmikoAuthenticationException):
         return False
+    return isinstance(error, (NetmikoTimeoutException, ReadTimeout, SSHException, OSError, EOFError))
 
 
-def change_hostname_qsr(qsr_ip_address, qsr_username, qsr_password, qsr_dev_name, qsr_session_log=None):
+def sync_device(ip, dev_info, dev_username, dev_password, timeouts=None, read_only=False, bastion=None,
+                detect=False):
     """
-    Функция меняет hostname железки, если оно не соответствует имени в netbox
+    Функция проверяет и при необходимости меняет hostname и другие атрибуты (managed_attributes) одного устройства.
+    Выполняется в пуле потоков, поэтому ничего не печатает, а возвращает результат.
 
     Параметры:
-        qsr_ip_address (str): ip address устройства.
-        qsr_username (str): Имя пользователя для устройства.
-        qsr_password (str): Пароль для устройства.
-        qsr_dev_name (str): Имя устройства в netbox
-        qsr_session_log (bool, optional): Включение/выключение логирования ssh сессий
+        ip (str): ip address устройства.
+        dev_info (dict): Вложенный словарь из get_devices с именем устройства и его платформой. Значения атрибутов
+                         берутся из dev_info["attributes"] (см. add_attributes), без него сверяется только hostname.
+        dev_username (str): Имя пользователя для устройства.
+        dev_password (str): Пароль для устройства.
+        timeouts (dict, optional): Таймауты для устройства из LatencyStats.timeouts().
+        read_only (bool, optional): Только прочитать атрибуты и сравнить с NetBox, ничего не меняя (режим plan).
+        bastion (BastionPool, optional): Пул подключений к jump host.
+        detect (bool, optional): Перед сверкой определить платформу устройства (detect_platform) и работать
+                                 по ней, если она определилась.
 
     Возвращает:
-        bool: True, если имя устройства было изменено.
-              False, если имя устройства уже соответствует имени в NetBox.
+        dict: Результат с ключами ip, netbox_id, site, role, device_name, device_platform, netbox_platform, detected,
+              detected_platform, device_hostname, drift, status, error, transient, failed_phase, timings
+              и duration.
+              status - "changed", "in_sync", "drift" (только при read_only), "failed" или "unknown_platform".
+              device_platform - платформа, по которой обрабатывалось устройство, netbox_platform - платформа
+              в NetBox, detected - выполнялось ли определение платформы, detected_platform - его результат.
+              device_hostname - hostname на устройстве, drift - атрибуты, которые отличались от NetBox.
+              transient - True, если ошибка временная и обработку можно повторить.
+              failed_phase - этап из timings, на котором произошла ошибка.
+              timings - длительность этапов обработки в секундах, duration - общая длительность.
     """
-    device_info = {
-        "device_type": "cisco_xe",
-        "ip": qsr_ip_address,
-        "username": qsr_username,
-        "password": qsr_password,
-        "read_timeout_override": 30,
+    result = {
+        "ip": ip,
+        "netbox_id": dev_info.get("netbox_id"),
+        "site": dev_info.get("site"),
+        "role": dev_info.get("role"),
+        "device_name": dev_info["device_name"],
+        "device_platform": dev_info["device_platform"],
+        "netbox_platform": dev_info.get("netbox_platform", dev_info["device_platform"]),
+        "detected": False,
+        "detected_platform": None,
+        "device_hostname": None,
+        "drift": [],
+        "status": "unknown_platform",
+        "error": None,
+        "transient": False,
+        "failed_phase": None,
+        "timings": {},
+        "duration": None,
     }
-    if qsr_session_log:
-        device_info["session_log"] = f"{qsr_ip_address}.log"
+    if detect:
+        start = time.perf_counter()
+        try:
+            result["detected_platform"] = detect_platform(ip, dev_username, dev_password, timeouts, bastion)
+            result["detected"] = True
+        except Exception as e:
+            result["status"] = "failed"
+            result["error"] = f"Platform detection failed: {e}"
+            result["transient"] = is_transient_error(e)
+            return result
+        finally:
+            result["timings"]["detect"] = time.perf_counter() - start
+        if result["detected_platform"]:
+            result["device_platform"] = result["detected_platform"]
+    profile = platform_profiles.get(result["device_platform"])
+    if profile is None:
+        return result
+    # Атрибуты, для которых в профиле платформы нет команд, не сверяются
+    desired = {name: value for name, value in (dev_info.get("attributes") or
+                                               {"hostname": dev_info["device_name"]}).items()
+               if name == "hostname" or name in profile["attributes"]}
+    try:
+        with platform_semaphores.get(result["device_platform"], nullcontext()):
+            start = time.perf_counter()
+            try:
+                current, result["drift"] = reconcile_device(ip, dev_username, dev_password, desired, profile,
+                                                            result["timings"], timeouts, bastion, read_only)
+                result["device_hostname"] = current.get("hostname")
+                if not result["drift"]:
+                    result["status"] = "in_sync"
+                else:
+                    result["status"] = "drift" if read_only else "changed"
+            finally:
+                result["duration"] = time.perf_counter() - start
+    except Exception as e:
+        result["status"] = "failed"
+        result["error"] = str(e)
+        result["transient"] = is_transient_error(e)
+        # Этапы пишутся в timings по порядку, последний перед disconnect - тот, на котором произошла ошибка
+        result["failed_phase"] = next((phase for phase in reversed(result["timings"]) if phase != "disconnect"),
+                                      None)
+        if result["failed_phase"] in ("config_push", "save"):
+            result["error"] = f"Configuration may be applied but not saved: {e}"
+    return result
 
-    net_connect = ConnectHandler(**device_info)
-    net_connect.send_command("more off")
-    sh_qsr_hostname = net_connect.send_command("show running-config | include hostname")
-    sh_qsr_hostname = sh_qsr_hostname.split("\n")
-    for i in sh_qsr_hostname:
-        if i.startswith("hostname"):
-            sh_qsr_hostname = i[9::]
-            break
-    if qsr_dev_name != sh_qsr_hostname:
-        net_connect.send_config_set(f"hostname {qsr_dev_name}")
-        wr_mem = net_connect.send_command_timing("write")
-        if "Are you sure to overwrite" in wr_mem:
-            wr_mem += net_connect.send_command_timing("Y")
-        net_connect.disconnect()
-        return True
+
+class LatencyStats:
+    """
+    Статистика длительности подключения и ответа устройств за прошлые запуски и расчет адаптивных таймаутов.
+    Хранится в таблице latency_stats: последние timeout_device_history замеров per device
+    и timeout_platform_history замеров per platform для этапов conn (tcp_connect), auth (ssh_auth),
+    read (самый долгий из этапов чтения: prompt_discovery, hostname_query) и write (самый долгий из этапов
+    записи: config_push, save). Таймаут read применяется к чтению, write - к конфигурированию и сохранению.
+    """
+
+    phases = ("conn", "auth", "read", "write")
+    # Этапы sync_device, из которых считаются замеры read и write
+    read_phases = ("prompt_discovery", "hostname_query")
+    write_phases = ("config_push", "save")
+
+    def __init__(self, db):
+        self.db = db
+        self.samples = {}
+        self.changed = set()
+        for scope, key, samples in db.execute("SELECT scope, key, samples FROM latency_stats"):
+            self.samples[(scope, key)] = json.loads(samples)
+
+    def timeouts(self, ip, platform):
+        """
+        Возвращает таймауты conn, auth и read для устройства: перцентиль timeout_percentile замеров устройства
+        (или платформы, если замеров устройства меньше timeout_min_samples), умноженный на timeout_margin
+        и ограниченный timeout_min и timeout_max. Этапы без достаточной статистики в словарь не попадают.
+        """
+        timeouts = {}
+        for phase in self.phases:
+            for scope, key in (("device", ip), ("platform", platform)):
+                values = self.samples.get((scope, key), {}).get(phase, [])
+                if len(values) >= timeout_min_samples:
+                    value = RunMetrics.quantile(sorted(values), timeout_percentile) * timeout_margin
+                    timeouts[phase] = round(min(timeout_max, max(timeout_min, value)), 2)
+                    break
+        return timeouts
+
+    def add(self, result):
+        """
+        Добавляет замеры обработки устройства из sync_device. Из неудачной попытки учитывается только этап
+        чтения или записи, на котором истек таймаут ответа: его длительность (не меньше самого таймаута)
+        добавляется замером, чтобы таймаут мог вырасти обратно, если устройство стало отвечать медленнее.
+        Таймауты подключения неудачных попыток не учитываются: это обычно недоступное устройство.
+        """
+        timings = result["timings"]
+        if result["status"] == "failed":
+            phase = result.get("failed_phase")
+            if not result["transient"] or phase not in self.read_phases + self.write_phases:
+                return
+            sample = {"read" if phase in self.read_phases else "write": timings[phase]}
+        elif result["status"] in ("changed", "in_sync", "drift"):
+            sample = {
+                "conn": timings.get("tcp_connect"),
+                "auth": timings.get("ssh_auth"),
+                "read": max((timings[phase] for phase in self.read_phases if phase in timings), default=None),
+                "write": max((timings[phase] for phase in self.write_phases if phase in timings), default=None),
+            }
+        else:
+            return
+        for scope, key, history in (("device", result["ip"], timeout_device_history),
+                                    ("platform", result["device_platform"], timeout_platform_history)):
+            samples = self.samples.setdefault((scope, key), {})
+            for phase, value in sample.items():
+                if value is not None:
+                    samples[phase] = (samples.get(phase, []) + [round(value, 4)])[-history:]
+            self.changed.add((scope, key))
+
+    def save(self):
+        """
+        Сохраняет измененную статистику в базу.
+        """
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO latency_stats (scope, key, samples) VALUES (?, ?, ?)",
+                                [(scope, key, json.dumps(self.samples[(scope, key)]))
+                                 for scope, key in self.changed])
+        self.changed.clear()
+
+
+class RunMetrics:
+    """
+    Сбор длительности этапов обработки устройств за запуск.
+    Каждый результат сразу дописывается в timings_file (json lines), а в конце запуска по всем результатам
+    пишется metrics_file в формате Prometheus: гистограммы и p50/p95/p99 длительности этапов per platform.
+    """
+
+    def __init__(self, jsonl_path=None):
+        self.samples = {}
+        self.statuses = {}
+        self.jsonl = open(jsonl_path, "w", encoding="utf-8") if jsonl_path else None
+
+    def add(self, result):
+        """
+        Добавляет результат обработки устройства из sync_device.
+        """
+        platform = result["device_platform"] or ""
+        self.statuses[(platform, result["status"])] = self.statuses.get((platform, result["status"]), 0) + 1
+        if result.get("duration") is None:
+            return
+        phases = dict(result["timings"], total=result["duration"])
+        for phase, seconds in phases.items():
+            self.samples.setdefault((platform, phase), []).append(seconds)
+        if self.jsonl:
+            self.jsonl.write(json.dumps({
+                "time": datetime.now(timezone.utc).isoformat(),
+                "ip": result["ip"],
+                "device_name": result["device_name"],
+                "device_platform": result["device_platform"],
+                "status": result["status"],
+                "phases": {phase: round(seconds, 4) for phase, seconds in phases.items()},
+            }) + "\n")
+            self.jsonl.flush()
+
+    @staticmethod
+    def quantile(sorted_values, q):
+        """
+        Возвращает квантиль q (0..1) отсортированного списка методом ближайшего ранга.
+        """
+        index = max(0, min(len(sorted_values) - 1, math.ceil(q * len(sorted_values)) - 1))
+        return sorted_values[index]
+
+    def write_prometheus(self, path):
+        """
+        Пишет метрики в файл для textfile collector node_exporter.
+        Файл сначала пишется во временный и затем переименовывается, чтобы collector не прочитал его частично.
+        """
+        lines = [
+            "# HELP hostname_sync_phase_duration_seconds Duration of device reconciliation phases.",
+            "# TYPE hostname_sync_phase_duration_seconds histogram",
+        ]
+        for (platform, phase), values in sorted(self.samples.items()):
+            labels = f'platform="{platform}",phase="{phase}"'
+            for bucket in metrics_buckets:
+                count = sum(1 for value in values if value <= bucket)
+                lines.append(f'hostname_sync_phase_duration_seconds_bucket{{{labels},le="{bucket}"}} {count}')
+            lines.append(f'hostname_sync_phase_duration_seconds_bucket{{{labels},le="+Inf"}} {len(values)}')
+            lines.append(f"hostname_sync_phase_duration_seconds_sum{{{labels}}} {sum(values):.6f}")
+            lines.append(f"hostname_sync_phase_duration_seconds_count{{{labels}}} {len(values)}")
+        lines += [
+            "# HELP hostname_sync_phase_duration_quantile_seconds Quantiles of device reconciliation phases.",
+            "# TYPE hostname_sync_phase_duration_quantile_seconds summary",
+        ]
+        for (platform, phase), values in sorted(self.samples.items()):
+            labels = f'platform="{platform}",phase="{phase}"'
+            sorted_values = sorted(values)
+            for q in (0.5, 0.95, 0.99):
+                lines.append(f'hostname_sync_phase_duration_quantile_seconds{{{labels},quantile="{q}"}} '
+                             f"{self.quantile(sorted_values, q):.6f}")
+            lines.append(f"hostname_sync_phase_duration_quantile_seconds_sum{{{labels}}} {sum(values):.6f}")
+            lines.append(f"hostname_sync_phase_duration_quantile_seconds_count{{{labels}}} {len(values)}")
+        lines += [
+            "# HELP hostname_sync_devices Devices processed in the last run by status.",
+            "# TYPE hostname_sync_devices gauge",
+        ]
+        for (platform, status), count in sorted(self.statuses.items()):
+            lines.append(f'hostname_sync_devices{{platform="{platform}",status="{status}"}} {count}')
+        lines.append(f"hostname_sync_last_run_timestamp_seconds {time.time():.0f}")
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+
+    def close(self):
+        if self.jsonl:
+            self.jsonl.close()
+
+
+class RunJournal:
+    """
+    Журнал запуска в формате json lines: итог по каждому устройству дописывается сразу после обработки.
+    При продолжении прерванного запуска (resume=True) журнал дописывается, а уже обработанные устройства
+    пропускаются.
+    """
+
+    def __init__(self, path, resume=False):
+        self.done = set()
+        if resume and os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        self.done.add(json.loads(line)["ip"])
+                    except (json.JSONDecodeError, KeyError):
+                        # Последняя строка могла не дописаться при аварийном завершении
+                        continue
+        self.file = open(path, "a" if resume else "w", encoding="utf-8")
+
+    def pending(self, devices):
+        """
+        Генератор пропускает устройства, которые уже обработаны по журналу.
+        """
+        for ip, dev_info in devices:
+            if ip not in self.done:
+                yield ip, dev_info
+
+    def add(self, result, attempts=1):
+        """
+        Дописывает итог обработки устройства.
+        """
+        self.file.write(json.dumps({
+            "time": datetime.now(timezone.utc).isoformat(),
+            "ip": result["ip"],
+            "device_name": result["device_name"],
+            "device_platform": result["device_platform"],
+            "status": result["status"],
+            "error": result["error"],
+            "attempts": attempts,
+        }) + "\n")
+        self.file.flush()
+        self.done.add(result["ip"])
+
+    def close(self):
+        self.file.close()
+
+
+class PlatformDetector:
+    """
+    Кэш автоопределения платформы (autodetect_platform) в таблице detected_platform: платформа, определенная
+    для ip, используется без повторного определения, пока не изменилась платформа устройства в NetBox
+    и не истек autodetect_ttl. Определение выполняется в потоке обработки устройства (sync_device),
+    а результат сохраняется в основном потоке.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.cache = {}
+        for ip, netbox_platform, detected_platform, detected_at in db.execute(
+                "SELECT ip, netbox_platform, detected_platform, detected_at FROM detected_platform"):
+            if datetime.now(timezone.utc) - datetime.fromisoformat(detected_at) < timedelta(seconds=autodetect_ttl):
+                self.cache[ip] = (netbox_platform, detected_platform)
+
+    def prepare(self, ip, dev_info):
+        """
+        Подставляет в dev_info платформу из кэша и определяет, нужно ли определять платформу устройства.
+
+        Возвращает:
+            tuple: (dev_info, detect) - dev_info с платформой для обработки и исходной платформой из NetBox
+                   в netbox_platform, detect - True, если платформу нужно определить в сессии.
+        """
+        netbox_platform = dev_info.get("netbox_platform", dev_info["device_platform"])
+        dev_info = dict(dev_info, netbox_platform=netbox_platform)
+        cached = self.cache.get(ip)
+        if cached is not None and cached[0] == netbox_platform:
+            return dict(dev_info, device_platform=cached[1] or netbox_platform), False
+        detect = autodetect_platform == "all" or netbox_platform not in platform_profiles
+        return dict(dev_info, device_platform=netbox_platform), detect
+
+    def add(self, result):
+        """
+        Сохраняет результат определения платформы из sync_device. Нераспознанная платформа тоже запоминается,
+        чтобы не определять ее в каждом запуске.
+        """
+        if not result.get("detected"):
+            return
+        self.cache[result["ip"]] = (result["netbox_platform"], result["detected_platform"])
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO detected_platform "
+                            "(ip, device_name, netbox_platform, detected_platform, detected_at) VALUES (?, ?, ?, ?, ?)",
+                            (result["ip"], result["device_name"], result["netbox_platform"],
+                             result["detected_platform"], datetime.now(timezone.utc).isoformat()))
+
+    def write_report(self, path):
+        """
+        Пишет в csv устройства, у которых определенная платформа не совпадает с платформой в NetBox
+        или не определилась, по всем запускам.
+
+        Возвращает:
+            int: Кол-во устройств в отчете.
+        """
+        rows = self.db.execute(
+            "SELECT ip, device_name, netbox_platform, detected_platform, detected_at FROM detected_platform "
+            "WHERE detected_platform IS NULL OR netbox_platform IS NULL OR netbox_platform != detected_platform "
+            "ORDER BY device_name").fetchall()
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["ip", "device_name", "netbox_platform", "detected_platform", "detected_at"])
+            writer.writerows(rows)
+        return len(rows)
+
+
+class DriftReport:
+    """
+    Отчет о расхождениях (режим plan): по каждому проверенному устройству ip, площадка, роль, платформа,
+    имя в NetBox, hostname на устройстве, отличающиеся атрибуты и статус. Пишется в json или csv (по расширению
+    файла) и читается режимом apply.
+    """
+
+    fields = ("ip", "netbox_id", "site", "role", "device_platform", "device_name", "device_hostname", "drift",
+              "status", "error")
+
+    def __init__(self):
+        self.rows = []
+
+    def add(self, result):
+        """
+        Добавляет итог проверки устройства. Отличающиеся атрибуты записываются через запятую.
+        """
+        row = {field: result.get(field) for field in self.fields}
+        row["drift"] = ",".join(result.get("drift") or [])
+        self.rows.append(row)
+
+    def write(self, path):
+        """
+        Пишет отчет, устройства с расхождением - первыми.
+        """
+        rows = sorted(self.rows, key=lambda row: (row["status"] != "drift", row["device_name"]))
+        if path.endswith(".csv"):
+            with open(path, "w", encoding="utf-8", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=self.fields)
+                writer.writeheader()
+                writer.writerows(rows)
+        else:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump({"created": datetime.now(timezone.utc).isoformat(), "devices": rows}, f,
+                          ensure_ascii=False, indent=2)
+
+    @staticmethod
+    def load_drifted(path):
+        """
+        Читает отчет и возвращает устройства с расхождением hostname.
+
+        Возвращает:
+            dict: Словарь устройств в формате get_devices.
+        """
+        if path.endswith(".csv"):
+            with open(path, encoding="utf-8", newline="") as f:
+                rows = list(csv.DictReader(f))
+        else:
+            with open(path, encoding="utf-8") as f:
+                rows = json.load(f)["devices"]
+        # В отчетах прошлых версий роли нет
+        return {row["ip"]: {"netbox_id": int(row["netbox_id"]) if row["netbox_id"] else None,
+                            "site": row["site"] or None,
+                            "role": row.get("role") or None,
+                            "device_platform": row["device_platform"] or None,
+                            "device_name": row["device_name"]}
+                for row in rows if row["status"] == "drift"}
+
+
+class NetBoxWriteback:
+    """
+    Запись результата синхронизации в custom fields устройств в NetBox (writeback_fields).
+    Результаты копятся и отправляются пачками по netbox_writeback_batch устройств одним bulk PATCH запросом.
+    """
+
+    def __init__(self, nb_url, nb_token):
+        self.nb = api(url=nb_url, token=nb_token)
+        self.pending = []
+
+    def add(self, result):
+        """
+        Добавляет итог обработки устройства. Пропущенные устройства и расхождения режима plan не пишутся.
+        """
+        if result.get("netbox_id") is None:
+            return
+        now = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        if result["status"] == "changed":
+            fields = {"last_verified": now, "last_changed": now, "last_error": None}
+        elif result["status"] == "in_sync":
+            fields = {"last_verified": now, "last_error": None}
+        elif result["status"] == "failed":
+            # Ошибки netmiko бывают многострочными, в NetBox пишется только начало
+            fields = {"last_error": f"{now} {result['error']}"[:500]}
+        elif result["status"] == "unknown_platform":
+            fields = {"last_error": f"{now} Unknown platform {result['device_platform']}"}
+        else:
+            return
+        self.pending.append({"id": result["netbox_id"],
+                             "custom_fields": {writeback_fields[key]: value for key, value in fields.items()}})
+        if len(self.pending) >= netbox_writeback_batch:
+            self.flush()
+
+    def flush(self):
+        """
+        Отправляет накопленные результаты в NetBox. Ошибка записи не прерывает запуск, а пишется в error.log.
+        """
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        try:
+            self.nb.dcim.devices.update(batch)
+        except Exception as e:
+            error_msg = f"Failed to write sync status of {len(batch)} devices to NetBox: {e}"
+            print(error_msg)
+            logging.error(error_msg)
+
+
+def report_result(result):
+    """
+    Функция печатает итог обработки устройства и пишет ошибку в error.log.
+
+    Параметры:
+        result (dict): Результат из sync_device.
+    """
+    if result["status"] == "changed" and result.get("drift", ["hostname"]) == ["hostname"]:
+        print(f"Connected to {result['device_name']} (ip {result['ip']}): Hostname change")
+    elif result["status"] == "changed":
+        print(f"Connected to {result['device_name']} (ip {result['ip']}): Changed {', '.join(result['drift'])}")
+    elif result["status"] == "in_sync":
+        print(f"Connected to {result['device_name']} (ip {result['ip']}): Hostname is already sync with NetBox")
+    elif result["status"] == "drift":
+        print(f"Connected to {result['device_name']} (ip {result['ip']}): "
+              f"{', '.join(result['drift'])} differs from NetBox (hostname {result['device_hostname']})")
+    elif result["status"] == "skipped":
+        print(f"Device {result['device_name']} (ip {result['ip']}) was recently verified, skipped")
+    elif result["status"] == "unknown_platform":
+        print(f"Device {result['device_name']} ({result['device_platform']}) is not a known platform.")
     else:
-        net_connect.disconnect()
-        return False
+        error_msg = f"Failed to connect to {result['device_name']} (ip {result['ip']}): {result['error']}"
+        print(error_msg)
+        logging.error(error_msg)
 
 
-# Получаем словарь с объектами
-devices_dict = get_devices(netbox_url, netbox_token, name_regex)
+class SiteScheduler:
+    """
+    Очередь устройств по площадкам NetBox (site_scheduler). Устройства выдаются по кругу по площадкам,
+    на одной площадке одновременно обрабатывается не более site_max_sessions устройств, в одном регионе - не более
+    region_max_sessions. Устройства с ролями из role_priority выдаются раньше остальных на всех площадках.
+    Устройства без площадки или региона этими ограничениями не учитываются.
+    """
 
-if devices_dict:
-    # Считаем кол-во устройств, для вывода инфо
-    all_keys_count = len(devices_dict.keys())
-    print(f"Summary device get from NetBox is {all_keys_count}\n\n")
-    # Фиктивная переменная, для паузы скрипта до ввода любого символа
-    garbage = input("Please ENTER for start script")
+    def __init__(self):
+        # Площадка -> куча (приоритет роли, порядковый номер, ip, dev_info, номер попытки)
+        self.queues = {}
+        # Порядок обхода площадок по кругу и площадка, с которой начинается следующий обход
+        self.sites = []
+        self.position = 0
+        self.order = itertools.count()
+        # Кол-во устройств в очереди по приоритету роли
+        self.tiers = Counter()
+        self.site_sessions = Counter()
+        self.region_sessions = Counter()
 
-    # Итерируемся по словарю и получаем значения ключей
-    for ip, dev_info in devices_dict.items():
+    def __len__(self):
+        return sum(self.tiers.values())
 
-        # Проверяем hostname устройств с платформой cisco
-        if dev_info["device_platform"] == cisco:
-            try:
-                print(f"Connected to {dev_info['device_name']} (ip {ip})")
-                if change_hostname_cisco(ip, username, password, dev_info['device_name'], enable_cisco_sessions_log):
-                    print("Hostname change")
-                else:
-                    print(f"Hostname is already sync with NetBox")
-            except Exception as e:
-                error_msg = f"Failed to connect to {dev_info['device_name']} (ip {ip}): {e}"
-                print(error_msg)
-                logging.error(error_msg)
-
-        # Проверяем hostname устройств с платформой mesos23
-        elif dev_info["device_platform"] == mes23:
-            try:
-                print(f"Connected to {dev_info['device_name']} (ip {ip})")
-                if change_hostname_mes23(ip, username, password, dev_info['device_name'], enable_mes23_sessions_log):
-                    print("Hostname change")
-                else:
-                    print(f"Hostname is already sync with NetBox")
-            except Exception as e:
-                error_msg = f"Failed to connect to {dev_info['device_name']} (ip {ip}): {e}"
-                print(error_msg)
-                logging.error(error_msg)
-
-        # Проверяем hostname устройств с платформой mesos24
-        elif dev_info["device_platform"] == mes24:
-            try:
-                print(f"Connected to {dev_info['device_name']} (ip {ip})")
-                if change_hostname_mes24(ip, username, password, dev_info['device_name'], enable_mes24_sessions_log):
-                    print("Hostname change")
-                else:
-                    print(f"Hostname is already sync with NetBox")
-            except Exception as e:
-                error_msg = f"Failed to connect to {dev_info['device_name']} (ip {ip}): {e}"
-                print(error_msg)
-                logging.error(error_msg)
-
-        # Проверяем hostname устройств с платформой eltex esr
-        elif dev_info["device_platform"] == esr:
-            try:
-                print(f"Connected to {dev_info['device_name']} (ip {ip})")
-                if change_hostname_esr(ip, username, password, dev_info['device_name'], enable_esr_sessions_log):
-                    print("Hostname change")
-                else:
-                    print(f"Hostname is already sync with NetBox")
-            except Exception as e:
-                error_msg = f"Failed to connect to {dev_info['device_name']} (ip {ip}): {e}"
-                print(error_msg)
-                logging.error(error_msg)
-
-        # Проверяем hostname устройств с платформой qtech (это qsw46)
-        elif dev_info["device_platform"] == qtech46:
-            try:
-                print(f"Connected to {dev_info['device_name']} (ip {ip})")
-                if change_hostname_qsw46(ip, username, password, dev_info['device_name'], enable_qsw46_sessions_log):
-                    print("Hostname change")
-                else:
-                    print(f"Hostname is already sync with NetBox")
-            except Exception as e:
-                error_msg = f"Failed to connect to {dev_info['device_name']} (ip {ip}): {e}"
-                print(error_msg)
-                logging.error(error_msg)
-
-        # Проверяем hostname устройств с платформой qsw33
-        elif dev_info["device_platform"] == qtech33:
-            try:
-                print(f"Connected to {dev_info['device_name']} (ip {ip})")
-                if change_hostname_qsw33(ip, username, password, dev_info['device_name'], enable_qsw33_sessions_log):
-                    print("Hostname change")
-                else:
-                    print(f"Hostname is already sync with NetBox")
-            except Exception as e:
-                error_msg = f"Failed to connect to {dev_info['device_name']} (ip {ip}): {e}"
-                print(error_msg)
-                logging.error(error_msg)
-
-        # Проверяем hostname устройств с платформой qsr
-        elif dev_info["device_platform"] == qsr:
-            try:
-                print(f"Connected to {dev_info['device_name']} (ip {ip})")
-                if change_hostname_qsw33(ip, username, password, dev_info['device_name'], enable_qsr_sessions_log):
-                    print("Hostname change")
+    def add(self, ip, dev_info, attempt):
+        site = dev_info.get("site")
+        if site not in self.queues:
+            self.queues[site] = []
+            self.sites.append(site)
+        role = dev_info.get("role")
+        tier = role_priority.index(role) if role in role_priority else len(role_priority)
+        heapq.heappush(self.queues[site], (tier, next(self.order), ip, dev_info, attempt))
+        self.tiers[tier] += 1
+
+    def available(self, site, region):
+        if site is not None and site_max_sessions and self.site_sessions[site] >= site_max_sessions:
+            return False
+        if region is not None and region_max_sessions and self.region_sessions[region] >= region_max_sessions:
+            return False
+        return True
+
+    def next(self):
+        """
+        Возвращает (ip, dev_info, attempt) следующего устройства или None, если все площадки с устройствами
+        в очереди уже заняты до предела.
+        """
+        best_tier = min((tier for tier, count in self.tiers.items() if count), default=None)
+        chosen = None
+        for offset in range(len(self.sites)):
+            index = (self.position + offset) % len(self.sites)
+            queue = self.queues[self.sites[index]]
+            if not self.available(self.sites[index], queue[0][3].get("region")):
+                continue
+            if chosen is None or queue[0][0] < self.queues[self.sites[chosen]][0][0]:
+                chosen = index
+            # Устройство с самым высоким приоритетом из оставшихся найдено, дальше можно не смотреть
+            if queue[0][0] == best_tier:
+                break
+        if chosen is None:
+            return None
+        site = self.sites[chosen]
+        tier, _, ip, dev_info, attempt = heapq.heappop(self.queues[site])
+        self.tiers[tier] -= 1
+        if self.queues[site]:
+            self.position = chosen + 1
+        else:
+            # Площадка без устройств убирается из обхода, на ее место сдвигается следующая
+            del self.queues[site]
+            del self.sites[chosen]
+            self.position = chosen
+        if site is not None:
+            self.site_sessions[site] += 1
+        if dev_info.get("region") is not None:
+            self.region_sessions[dev_info["region"]] += 1
+        return ip, dev_info, attempt
+
+    def done(self, dev_info):
+        """
+        Освобождает место на площадке и в регионе устройства после окончания его обработки.
+        """
+        if dev_info.get("site") is not None:
+            self.site_sessions[dev_info["site"]] -= 1
+        if dev_info.get("region") is not None:
+            self.region_sessions[dev_info["region"]] -= 1
+
+
+def run_sync(devices, dev_username, dev_password, total=None, state_db=None, skip_verified=True, metrics=None,
+             latency_stats=None, journal=None, plan=None, writeback=None, bastion=None, detector=None):
+    """
+    Функция параллельно обрабатывает устройства в пуле из max_workers потоков
+    и печатает результат по каждому устройству по мере завершения.
+    Устройства забираются из devices по мере освобождения потоков (в очереди не более 2 * max_workers),
+    поэтому devices может быть генератором, который еще догружает страницы из NetBox.
+    С site_scheduler устройства сначала загружаются целиком в SiteScheduler и отдаются в пул по кругу
+    по площадкам, только когда есть свободный поток.
+    Устройства с временной ошибкой ставятся в очередь повторов и обрабатываются в конце запуска,
+    с паузой retry_base_delay, удваивающейся с каждой попыткой, всего не более retry_max_attempts попыток.
+
+    Параметры:
+        devices (iterable): Пары (ip, dev_info), например devices_dict.items() или iter_devices(...).
+        dev_username (str): Имя пользователя для устройства.
+        dev_password (str): Пароль для устройства.
+        total (int, optional): Общее кол-во устройств, если известно заранее, для вывода остатка.
+        state_db (sqlite3.Connection, optional): База кэша проверенных устройств. None - кэш не используется.
+        skip_verified (bool, optional): Пропускать недавно проверенные устройства. При False (полный аудит)
+                                        проверяются все устройства, но результаты проверки все равно сохраняются.
+        metrics (RunMetrics, optional): Сбор длительности этапов обработки устройств.
+        latency_stats (LatencyStats, optional): Статистика прошлых запусков для адаптивных таймаутов.
+        journal (RunJournal, optional): Журнал запуска, в который пишется итог по каждому устройству.
+        plan (DriftReport, optional): Режим plan: hostname устройств только читается в пуле из plan_max_workers
+                                      потоков, итог по каждому устройству добавляется в отчет.
+        writeback (NetBoxWriteback, optional): Запись итога по каждому устройству в custom fields в NetBox.
+        bastion (BastionPool, optional): Пул подключений к jump host. None - устройства доступны напрямую.
+        detector (PlatformDetector, optional): Кэш автоопределения платформы. None - платформа берется из NetBox.
+
+    Возвращает:
+        dict: Кол-во устройств по каждому status.
+    """
+    summary = {"changed": 0, "in_sync": 0, "drift": 0, "skipped": 0, "failed": 0, "unknown_platform": 0}
+    workers = max_workers if plan is None else plan_max_workers
+    in_flight = {}
+    # Очередь повторов: (время, не раньше которого повторять, ip, dev_info, номер следующей попытки)
+    retries = []
+    scheduler = SiteScheduler() if site_scheduler else None
+
+    def handle(result, ip, dev_info, attempt):
+        if detector is not None:
+            detector.add(result)
+        if metrics is not None:
+            metrics.add(result)
+        if latency_stats is not None:
+            latency_stats.add(result)
+        # Ошибка при конфигурировании или сохранении не повторяется: изменения могли уже примениться,
+        # и повторная сверка увидела бы новые значения и не сохранила бы конфигурацию
+        if (result["status"] == "failed" and result["transient"] and attempt < retry_max_attempts
+                and result.get("failed_phase") not in ("config_push", "save")):
+            delay = retry_base_delay * 2 ** (attempt - 1)
+            retries.append((time.monotonic() + delay, ip, dev_info, attempt + 1))
+            print(f"Failed to connect to {result['device_name']} (ip {ip}): {result['error']}. "
+                  f"Retry {attempt + 1}/{retry_max_attempts} in {delay} s\n")
+            return
+        report_result(result)
+        summary[result["status"]] += 1
+        if journal is not None:
+            journal.add(result, attempt)
+        if plan is not None:
+            plan.add(result)
+        if writeback is not None:
+            writeback.add(result)
+        if state_db is not None and result["status"] in ("changed", "in_sync"):
+            save_verified(state_db, result["ip"], verified_key(dev_info))
+        processed = sum(summary.values())
+        if total is not None:
+            print(f"Remaining device count: {total - processed}\n")
+        else:
+            print(f"Processed device count: {processed}\n")
+
+    def submit(executor, ip, dev_info, attempt):
+        detect = False
+        if detector is not None:
+            dev_info, detect = detector.prepare(ip, dev_info)
+        timeouts = latency_stats.timeouts(ip, dev_info["device_platform"]) if latency_stats is not None else None
+        future = executor.submit(sync_device, ip, dev_info, dev_username, dev_password, timeouts, plan is not None,
+                                 bastion, detect)
+        in_flight[future] = (ip, dev_info, attempt)
+
+    def collect(timeout=None):
+        done, _ = wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            ip, dev_info, attempt = in_flight.pop(future)
+            if scheduler is not None:
+                scheduler.done(dev_info)
+            handle(future.result(), ip, dev_info, attempt)
+
+    def dispatch(executor):
+        # Устройства отдаются в пул, только когда есть свободный поток, чтобы ограничения на площадку и регион
+        # считались по открытым сессиям, а не по заданиям в очереди пула
+        while len(in_flight) < workers:
+            item = scheduler.next()
+            if item is None:
+                return
+            submit(executor, *item)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for ip, dev_info in devices:
+            if (state_db is not None and skip_verified
+                    and is_recently_verified(state_db, ip, verified_key(dev_info))):
+                handle({"ip": ip, "device_name": dev_info["device_name"],
+                        "device_platform": dev_info["device_platform"], "status": "skipped", "error": None,
+                        "transient": False, "timings": {}, "duration": None}, ip, dev_info, 1)
+                continue
+            if scheduler is not None:
+                scheduler.add(ip, dev_info, 1)
+                continue
+            submit(executor, ip, dev_info, 1)
+            if len(in_flight) >= 2 * workers:
+                collect()
+        while in_flight or retries or scheduler:
+            now = time.monotonic()
+            for retry in [retry for retry in retries if retry[0] <= now]:
+                retries.remove(retry)
+                if scheduler is not None:
+                    scheduler.add(*retry[1:])
                 else:
-                    print(f"Hostname is already sync with NetBox")
-            except Exception as e:
-                error_msg = f"Failed to connect to {dev_info['device_name']} (ip {ip}): {e}"
-                print(error_msg)
-                logging.error(error_msg)
+                    submit(executor, *retry[1:])
+            if scheduler is not None:
+                dispatch(executor)
+            next_retry = min((retry[0] for retry in retries), default=None)
+            if in_flight:
+                collect(None if next_retry is None else max(0.0, next_retry - now))
+            elif next_retry is not None:
+                time.sleep(max(0.0, next_retry - now))
+    return summary
+
+
+def print_summary(summary):
+    """
+    Функция печатает общую сводку по запуску.
+
+    Параметры:
+        summary (dict): Кол-во устройств по каждому status из run_sync.
+    """
+    print(f"Changed: {summary['changed']}, already in sync: {summary['in_sync']}, drift: {summary['drift']}, "
+          f"skipped: {summary['skipped']}, failed: {summary['failed']}, "
+          f"unreachable: {summary.get('unreachable', 0)}, unknown platform: {summary['unknown_platform']}")
+
+
+def load_devices(netbox_token, stale_only=False):
+    """
+    Функция получает словарь устройств из локального кэша инвентаря или напрямую из NetBox.
+
+    Параметры:
+        netbox_token (str): Токен для аутентификации в API NetBox.
+        stale_only (bool, optional): Только давно не проверенные устройства и устройства с ошибкой. Custom fields
+                                     в кэше инвентаря не хранятся, поэтому такие устройства всегда запрашиваются
+                                     из NetBox.
+
+    Возвращает:
+        dict: Словарь устройств, как в get_devices.
+    """
+    if inventory_cache and not stale_only:
+        return get_cached_devices(netbox_url, netbox_token, name_regex)
+    return get_devices(netbox_url, netbox_token, name_regex, stale_only=stale_only)
+
+
+def prescan_devices(devices_dict, db, writeback=None, plan=None):
+    """
+    Функция отделяет устройства с недоступным ssh портом, печатает их отдельным списком и пишет в error.log.
+
+    Параметры:
+        devices_dict (dict): Словарь устройств из get_devices.
+        db (sqlite3.Connection): Соединение с базой кэша.
+        writeback (NetBoxWriteback, optional): Запись ошибки недоступных устройств в custom fields в NetBox.
+        plan (DriftReport, optional): Отчет режима plan, в который недоступные устройства добавляются
+                                      со статусом unreachable.
+
+    Возвращает:
+        tuple: (reachable, unreachable) - словари устройств в формате devices_dict.
+    """
+    if bastion_host:
+        # Устройства доступны только через jump host, проверка доступности с локальной машины не имеет смысла
+        return devices_dict, {}
+    reachable, unreachable = split_unreachable(devices_dict, db)
+    print(f"Unreachable device count (tcp/{ssh_port}): {len(unreachable)}")
+    for ip, dev_info in unreachable.items():
+        error_msg = f"Device {dev_info['device_name']} (ip {ip}) is unreachable on tcp/{ssh_port}"
+        print(error_msg)
+        logging.error(error_msg)
+        if writeback is not None:
+            writeback.add({"ip": ip, "netbox_id": dev_info.get("netbox_id"), "device_name": dev_info["device_name"],
+                           "device_platform": dev_info["device_platform"], "status": "failed",
+                           "error": f"Unreachable on tcp/{ssh_port}"})
+        if plan is not None:
+            plan.add(dict(dev_info, ip=ip, status="unreachable", error=f"Unreachable on tcp/{ssh_port}"))
+    print()
+    return reachable, unreachable
+
+
+class DeviceEvents:
+    """
+    Очередь устройств из webhook NetBox с задержкой (debounce): устройство отдается в обработку через
+    daemon_debounce секунд после последнего события по нему, но не позже daemon_debounce_max секунд
+    после первого. Пачка событий по одному устройству (например, несколько правок подряд) склеивается в одну
+    проверку.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # id устройства в NetBox -> (время первого события, время последнего события)
+        self.pending = {}
+
+    def add(self, device_id):
+        now = time.monotonic()
+        with self.lock:
+            first_seen, _ = self.pending.get(device_id, (now, now))
+            self.pending[device_id] = (first_seen, now)
+
+    def pop_ready(self):
+        """
+        Возвращает id устройств, задержка по которым истекла, и убирает их из очереди.
+        """
+        now = time.monotonic()
+        with self.lock:
+            ready = [device_id for device_id, (first_seen, last_seen) in self.pending.items()
+                     if now - last_seen >= daemon_debounce or now - first_seen >= daemon_debounce_max]
+            for device_id in ready:
+                del self.pending[device_id]
+        return ready
+
+
+def is_writeback_event(payload):
+    """
+    Функция определяет, что событие NetBox вызвано только записью результата синхронизации в custom fields
+    (netbox_writeback). Такие события не должны запускать повторную проверку устройства, иначе каждая запись
+    результата вызывала бы новую проверку.
+
+    Параметры:
+        payload (dict): Тело webhook NetBox.
+
+    Возвращает:
+        bool: True, если между снимками до и после изменения отличаются только writeback_fields.
+    """
+    snapshots = payload.get("snapshots") or {}
+    prechange, postchange = snapshots.get("prechange"), snapshots.get("postchange")
+    if not prechange or not postchange:
+        return False
+    for key in set(prechange) | set(postchange):
+        if key not in ("last_updated", "custom_fields") and prechange.get(key) != postchange.get(key):
+            return False
+    pre_fields, post_fields = prechange.get("custom_fields") or {}, postchange.get("custom_fields") or {}
+    return all(pre_fields.get(key) == post_fields.get(key) for key in set(pre_fields) | set(post_fields)
+               if key not in writeback_fields.values())
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """
+    Прием webhook NetBox о создании и изменении устройств (модель device, события created и updated).
+    """
+    events = None
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if webhook_secret:
+            signature = hmac.new(webhook_secret.encode(), body, hashlib.sha512).hexdigest()
+            if not hmac.compare_digest(signature, self.headers.get("X-Hook-Signature", "")):
+                self.send_response(403)
+                self.end_headers()
+                return
+        try:
+            payload = json.loads(body)
+            device_id = payload["data"]["id"] if payload.get("model") == "device" else None
+        except (json.JSONDecodeError, AttributeError, KeyError, TypeError):
+            # Не json, не объект или событие устройства без data.id
+            self.send_response(400)
+            self.end_headers()
+            return
+        if (device_id is not None and payload.get("event") in ("created", "updated")
+                and not is_writeback_event(payload)):
+            self.events.add(device_id)
+        self.send_response(202)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def get_devices_by_id(nb_url, nb_token, device_name_regex, device_ids):
+    """
+    Функция получает из NetBox текущее состояние устройств по списку id с теми же фильтрами, что и get_devices.
+    Устройства, которые больше не активны, без primary ip или не подходят под регулярные выражения,
+    в результат не попадают.
+
+    Параметры:
+        nb_url (str): URL для доступа к API NetBox.
+        nb_token (str): Токен для аутентификации в API NetBox.
+        device_name_regex (list of re.Pattern): Список регулярных выражений для фильтрации имен устройств.
+        device_ids (list of int): id устройств в NetBox.
+
+    Возвращает:
+        dict: Словарь устройств, как в get_devices.
+    """
+    nb = api(url=nb_url, token=nb_token)
+    filtered_devices = {}
+    for device in nb.dcim.devices.filter(**build_device_query(device_name_regex), id=device_ids):
+        if any(regex.match(device.name) for regex in device_name_regex):
+            ip, dev_info = device_record(device)
+            filtered_devices[ip] = dev_info
+    return filtered_devices
+
 
+def full_sweep(dev_username, dev_password, netbox_token, full_audit=False, bastion=None):
+    """
+    Функция выполняет полную проверку всех устройств в сервисе. Выполняется в отдельном потоке,
+    поэтому открывает собственное соединение с базой кэша. Пул подключений к jump host общий с сервисом.
+    """
+    db = open_cache_db()
+    try:
+        print("Full sweep started")
+        devices_dict = dict(add_attributes(load_devices(netbox_token).items(), netbox_url, netbox_token))
+        writeback = NetBoxWriteback(netbox_url, netbox_token) if netbox_writeback else None
+        unreachable = {}
+        if prescan:
+            devices_dict, unreachable = prescan_devices(devices_dict, db, writeback)
+        latency_stats = LatencyStats(db) if adaptive_timeouts else None
+        detector = PlatformDetector(db) if autodetect_platform else None
+        metrics = RunMetrics()
+        summary = run_sync(devices_dict.items(), dev_username, dev_password, total=len(devices_dict),
+                           state_db=db if verified_cache else None, skip_verified=not full_audit,
+                           metrics=metrics, latency_stats=latency_stats, writeback=writeback, bastion=bastion,
+                           detector=detector)
+        if writeback is not None:
+            writeback.flush()
+        summary["unreachable"] = len(unreachable)
+        print("Full sweep finished")
+        print_summary(summary)
+        if metrics_file:
+            metrics.write_prometheus(metrics_file)
+        if latency_stats is not None:
+            latency_stats.save()
+        if detector is not None and platform_report_file:
+            detector.write_report(platform_report_file)
+    except Exception as e:
+        error_msg = f"Full sweep failed: {e}"
+        print(error_msg)
+        logging.error(error_msg)
+    finally:
+        db.close()
+
+
+def run_daemon(dev_username, dev_password, netbox_token, full_audit=False):
+    """
+    Функция запускает сервис: принимает webhook NetBox о создании и изменении устройств и проверяет только
+    эти устройства, а раз в daemon_full_sweep_interval секунд (и сразу при запуске) выполняет полную проверку.
+    Полная проверка и проверка устройств из webhook не выполняются одновременно: пока идет полная проверка,
+    события копятся в очереди, поэтому одно устройство не сверяется двумя сессиями сразу, а ограничения
+    max_workers, site_max_sessions и region_max_sessions действуют на все сессии сервиса.
+
+    Параметры:
+        dev_username (str): Имя пользователя для устройства.
+        dev_password (str): Пароль для устройства.
+        netbox_token (str): Токен для аутентификации в API NetBox.
+        full_audit (bool, optional): Полная проверка без пропуска недавно проверенных устройств.
+    """
+    events = DeviceEvents()
+    WebhookHandler.events = events
+    server = ThreadingHTTPServer(daemon_listen, WebhookHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Listening for NetBox webhooks on http://{daemon_listen[0]}:{daemon_listen[1]}/")
+
+    db = open_cache_db()
+    writeback = NetBoxWriteback(netbox_url, netbox_token) if netbox_writeback else None
+    bastion = BastionPool(dev_username, dev_password) if bastion_host else None
+    sweep_thread = None
+    next_sweep = time.monotonic()
+    try:
+        while True:
+            sweep_running = sweep_thread is not None and sweep_thread.is_alive()
+            device_ids = [] if sweep_running else events.pop_ready()
+            if device_ids:
+                try:
+                    # Статистика таймаутов и кэш платформ читаются из базы перед каждой пачкой: полная проверка
+                    # пишет в них из своего потока, и сохранение старой копии затерло бы ее замеры
+                    latency_stats = LatencyStats(db) if adaptive_timeouts else None
+                    detector = PlatformDetector(db) if autodetect_platform else None
+                    devices_dict = get_devices_by_id(netbox_url, netbox_token, name_regex, device_ids)
+                    devices_dict = dict(add_attributes(devices_dict.items(), netbox_url, netbox_token))
+                    # Устройство, измененное в NetBox, проверяется всегда, независимо от кэша проверенных
+                    run_sync(devices_dict.items(), dev_username, dev_password,
+                             state_db=db if verified_cache else None, skip_verified=False,
+                             latency_stats=latency_stats, writeback=writeback, bastion=bastion, detector=detector)
+                    if writeback is not None:
+                        writeback.flush()
+                    if latency_stats is not None:
+                        latency_stats.save()
+                except Exception as e:
+                    error_msg = f"Failed to reconcile devices {device_ids} from webhook: {e}"
+                    print(error_msg)
+                    logging.error(error_msg)
+            if time.monotonic() >= next_sweep and not sweep_running:
+                next_sweep = time.monotonic() + daemon_full_sweep_interval
+                sweep_thread = threading.Thread(target=full_sweep,
+                                                args=(dev_username, dev_password, netbox_token, full_audit,
+                                                      bastion),
+                                                daemon=True)
+                sweep_thread.start()
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        print("Service stopped")
+    finally:
+        server.shutdown()
+        if bastion is not None:
+            bastion.close()
+        db.close()
+
+
+def parse_args():
+    """
+    Функция разбирает аргументы командной строки.
+
+    Возвращает:
+        argparse.Namespace: Аргументы запуска.
+    """
+    parser = argparse.ArgumentParser(description="Синхронизация hostname сетевых устройств с NetBox")
+    parser.add_argument("--full-audit", action="store_true",
+                        help="проверить все устройства, не пропуская недавно проверенные")
+    parser.add_argument("--resume", action="store_true",
+                        help="продолжить прерванный запуск, пропуская устройства, уже обработанные по журналу")
+    parser.add_argument("--daemon", action="store_true",
+                        help="запуститься сервисом: проверять устройства по webhook NetBox и периодически все")
+    parser.add_argument("--stale", action="store_true",
+                        help="проверить только устройства, которые по custom fields в NetBox давно не проверялись "
+                             "или завершились ошибкой")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--plan", nargs="?", const=plan_file, metavar="FILE",
+                      help=f"только прочитать hostname всех устройств и записать отчет о расхождениях "
+                           f"(.json или .csv, по умолчанию {plan_file})")
+    mode.add_argument("--apply", nargs="?", const=plan_file, metavar="FILE",
+                      help="изменить hostname только устройств с расхождением из отчета --plan")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # Для запуска сервисом учетные данные можно передать через переменные окружения
+    username = os.environ.get("HOSTNAME_SYNC_USERNAME") or input("Enter your device login: ")
+    password = os.environ.get("HOSTNAME_SYNC_PASSWORD") or getpass.getpass("Enter your device password: ")
+    netbox_token = os.environ.get("NETBOX_TOKEN") or getpass.getpass("Enter your NetBox TOKEN: ")
+
+    logging.basicConfig(filename='error.log', filemode='a' if args.resume or args.daemon else 'w',
+                        level=logging.ERROR, format='%(asctime)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+    if args.daemon:
+        run_daemon(username, password, netbox_token, full_audit=args.full_audit)
+        return
+
+    db = open_cache_db()
+    state_db = db if verified_cache else None
+    latency_stats = LatencyStats(db) if adaptive_timeouts else None
+    metrics = RunMetrics(timings_file)
+    # Режим plan ничего не меняет, поэтому в журнал запуска не пишется
+    journal = RunJournal(journal_file, resume=args.resume) if not args.plan else None
+    plan = DriftReport() if args.plan else None
+    writeback = NetBoxWriteback(netbox_url, netbox_token) if netbox_writeback else None
+    bastion = BastionPool(username, password) if bastion_host else None
+    detector = PlatformDetector(db) if autodetect_platform else None
+    if args.resume and journal is not None:
+        print(f"Resume previous run, already handled device count: {len(journal.done)}")
+
+    if stream_inventory and not inventory_cache and not args.plan and not args.apply and not args.stale:
+        # Устройства обрабатываются по мере загрузки страниц из NetBox, общее кол-во заранее неизвестно
+        garbage = input("Please ENTER for start script")
+        devices = journal.pending(iter_unique_devices(iter_devices(netbox_url, netbox_token, name_regex)))
+        devices = add_attributes(devices, netbox_url, netbox_token)
+        summary = run_sync(devices, username, password, state_db=state_db, skip_verified=not args.full_audit,
+                           metrics=metrics, latency_stats=latency_stats, journal=journal, writeback=writeback,
+                           bastion=bastion, detector=detector)
+        if not sum(summary.values()):
+            print("Not device name match regex in NetBox.")
+        print_summary(summary)
+    else:
+        if args.apply:
+            # В apply обрабатываются только устройства с расхождением из отчета plan
+            devices_dict = DriftReport.load_drifted(args.apply)
+            print(f"Drifted device count in plan {args.apply}: {len(devices_dict)}")
+        else:
+            # Получаем словарь с объектами
+            devices_dict = load_devices(netbox_token, stale_only=args.stale)
+        if journal is not None:
+            devices_dict = dict(journal.pending(devices_dict.items()))
+        devices_dict = dict(add_attributes(devices_dict.items(), netbox_url, netbox_token))
+
+        if devices_dict:
+            # Считаем кол-во устройств, для вывода инфо
+            all_keys_count = len(devices_dict.keys())
+            print(f"Summary device get from NetBox is {all_keys_count}\n\n")
+            # Фиктивная переменная, для паузы скрипта до ввода любого символа
+            garbage = input("Please ENTER for start script")
+
+            unreachable = {}
+            if prescan:
+                devices_dict, unreachable = prescan_devices(devices_dict, db, writeback, plan)
+
+            # Режим plan читает все устройства, а устройства из плана проверяются всегда,
+            # независимо от кэша проверенных
+            summary = run_sync(devices_dict.items(), username, password, total=len(devices_dict),
+                               state_db=state_db,
+                               skip_verified=not args.full_audit and not args.plan and not args.apply,
+                               metrics=metrics, latency_stats=latency_stats, journal=journal, plan=plan,
+                               writeback=writeback, bastion=bastion, detector=detector)
+            summary["unreachable"] = len(unreachable)
+            print_summary(summary)
+            if plan is not None:
+                plan.write(args.plan)
+                print(f"Drift report is written to {args.plan}, apply it with --apply {args.plan}")
+        elif args.resume and journal is not None and journal.done:
+            print("All devices are already handled in previous run.")
+        elif args.apply:
+            print("No drifted devices in plan.")
         else:
-            print(f"Device {dev_info['device_name']} ({dev_info['device_platform']}) is not a known platform.")
+            print("Not device name match regex in NetBox.")
+
+    if writeback is not None:
+        writeback.flush()
+    if bastion is not None:
+        bastion.close()
+    if detector is not None and platform_report_file:
+        mismatch_count = detector.write_report(platform_report_file)
+        print(f"Devices with platform mismatch or unknown platform: {mismatch_count}, see {platform_report_file}")
+    if journal is not None:
+        journal.close()
+    metrics.close()
+    if metrics_file:
+        metrics.write_prometheus(metrics_file)
+    if latency_stats is not None:
+        latency_stats.save()
+    db.close()
+    print("Скрипт завершен")
 
-        all_keys_count -= 1
-        print(f"Remaining device count: {all_keys_count}\n")
-else:
-    print("Not device name match regex in NetBox.")
 
-print("Скрипт завершен")
+if __name__ == "__main__":
+    main()